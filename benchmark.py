@@ -0,0 +1,183 @@
+"""Headless benchmarks of the Little Tagger hot paths, prints or writes the timings as JSON
+
+    python benchmark.py --images 1000 10000 --tags 100 20000 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# must be set before Qt is loaded
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage, QColor
+from PyQt5.QtCore import QItemSelection, QItemSelectionModel, QT_VERSION_STR, PYQT_VERSION_STR
+
+def generate_dataset(directory, num_images, num_tags, tags_per_image=20, image_size=(640, 480), seed=0):
+    """Write num_images jpgs with sidecars drawing from a vocabulary of num_tags, reused if it exists"""
+    done_marker = os.path.join(directory, '.generated')
+    if os.path.exists(done_marker):
+        return directory
+    os.makedirs(directory, exist_ok=True)
+    rnd = random.Random(seed)
+    vocabulary = [f'tag {i}' for i in range(num_tags)]
+    # a few very common tags and a long tail, like real datasets
+    weights = [1.0 / (rank + 1) for rank in range(num_tags)]
+    image = QImage(image_size[0], image_size[1], QImage.Format_RGB32)
+    for i in range(num_images):
+        image.fill(QColor(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        path = os.path.join(directory, f'{i:07d}.jpg')
+        image.save(path, 'JPG', 80)
+        tags = set(rnd.choices(vocabulary, weights, k=min(tags_per_image, num_tags)))
+        with open(os.path.join(directory, f'{i:07d}.txt'), 'w') as f:
+            f.write(', '.join(tags))
+    open(done_marker, 'w').close()
+    return directory
+
+def wait_until(app, condition, timeout=600):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError('benchmark step did not finish in time')
+        app.processEvents()
+        time.sleep(0.001)
+
+def timed(results, name, function, **info):
+    started = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - started
+    results.append(dict(name=name, seconds=seconds, **info))
+    print(f'{name:40s} {seconds*1000:10.1f} ms  {info}', file=sys.stderr)
+    return seconds
+
+def run_benchmarks(app, tagger, directory, num_images, num_tags, crop_images):
+    info = dict(images=num_images, tags=num_tags)
+    results = []
+    window = tagger.ImageTagger()
+    window.show()
+
+    # switch_directory only counts once every sidecar is indexed
+    scanned = []
+    window.tag_scanner.finished.connect(lambda: scanned.append(True))
+    loaded = []
+    window.model.directoryLoaded.connect(lambda path: loaded.append(path))
+
+    def switch_directory():
+        window.switch_directory(directory)
+        wait_until(app, lambda: scanned)
+    timed(results, 'switch_directory', switch_directory, **info)
+    wait_until(app, lambda: loaded)
+
+    root = window.model.index(directory)
+    wait_until(app, lambda: window.model.rowCount(root) >= num_images)
+    window.model.sort(0)
+    first = window.model.index(0, 0, root)
+    last = window.model.index(window.model.rowCount(root) - 1, 0, root)
+
+    for count in sorted({1, min(100, num_images), num_images}):
+        def select():
+            selection = QItemSelection(first, window.model.index(count - 1, 0, root))
+            window.tree.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
+        timed(results, f'on_tree_selection_changed[{count}]', select, selection=count, **info)
+
+    if num_images > 1:
+        # shift+click one row further, only the new row should be looked at
+        def extend():
+            row = window.model.index(num_images - 1, 0, root)
+            window.tree.selectionModel().select(QItemSelection(row, row), QItemSelectionModel.Select | QItemSelectionModel.Rows)
+        window.tree.selectionModel().select(QItemSelection(first, window.model.index(num_images - 2, 0, root)),
+                                            QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
+        timed(results, 'on_tree_selection_changed[+1]', extend, selection=num_images, **info)
+
+    timed(results, 'highlight_pool', lambda: (window.highlight_pool(), app.processEvents()), **info)
+    timed(results, 'refresh_tagpool', window.refresh_tagpool, **info)
+
+    # a common tag added to the whole selection, saved when the selection changes
+    window.tree.selectionModel().select(QItemSelection(first, last), QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
+    window.add_tag('benchmark tag')
+    timed(results, 'save_current_tags', window.save_current_tags, selection=num_images, **info)
+    timed(results, 'save_current_tags+flush', window.tag_writer.flush, selection=num_images, **info)
+    window.taglist_model.remove('benchmark tag')
+    window.save_current_tags()
+    window.tag_writer.flush()
+
+    files = [window.model.filePath(window.model.index(row, 0, root)) for row in range(min(crop_images, num_images))]
+    with tempfile.TemporaryDirectory() as save_dir:
+        dialog = tagger.CropResizeAndSaveToDialog(window, files)
+        dialog.save_dir_edit.setText(save_dir)
+        dialog.do_override.setChecked(True)
+        finished = []
+        dialog.accepted.connect(lambda: finished.append(True))
+
+        def crop():
+            dialog.save_images()
+            wait_until(app, lambda: finished)
+        seconds = timed(results, 'CropResizeAndSaveToDialog', crop, files=len(files), **info)
+        results[-1]['files_per_second'] = len(files) / seconds
+
+    window.close()
+    window.deleteLater()
+    app.processEvents()
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, nargs='+', default=[1000, 10000], help='dataset sizes to run')
+    parser.add_argument('--tags', type=int, nargs='+', default=[100, 20000], help='vocabulary sizes to run')
+    parser.add_argument('--tags-per-image', type=int, default=20)
+    parser.add_argument('--crop-images', type=int, default=500, help='files run through the crop dialog')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'littletagger-benchmark'),
+                        help='generated datasets are kept here and reused')
+    parser.add_argument('--output', help='write the results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    # keep the user's thumbnail cache out of it, and start every run cold
+    os.makedirs(args.workdir, exist_ok=True)
+    cache_dir = tempfile.mkdtemp(prefix='cache-', dir=args.workdir)
+    os.environ['LITTLETAGGER_CACHE_DIR'] = cache_dir
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import tagger
+
+    app = QApplication([])
+    results = []
+    for num_images in args.images:
+        for num_tags in args.tags:
+            directory = os.path.join(args.workdir, f'{num_images}-images-{num_tags}-tags')
+            print(f'generating {directory}', file=sys.stderr)
+            generate_dataset(directory, num_images, num_tags, args.tags_per_image)
+            results.extend(run_benchmarks(app, tagger, directory, num_images, num_tags, args.crop_images))
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'qt': QT_VERSION_STR,
+        'pyqt': PYQT_VERSION_STR,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,46 @@
+import argparse
+import bisect
+import hashlib
+import heapq
+import io
 import json
 import math
+import multiprocessing
 import os
+import queue
 import shutil
+import sqlite3
+import sys
+import tarfile
 import threading
-from collections import namedtuple
+import time
+from array import array
+from collections import Counter, namedtuple, OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 
 from PyQt5.QtWidgets import QApplication, QCheckBox, QComboBox, QLabel, QPushButton, QMainWindow, QScrollArea, QHBoxLayout, QVBoxLayout, QWidget, QSizePolicy, QSplitter, QLayoutItem
-from PyQt5.QtWidgets import QLineEdit, QTextEdit, QMenu, QListView, QAction, QFileSystemModel, QTreeView, QProgressBar
-from PyQt5.QtWidgets import QFileDialog, QDialog, QListWidget, QListWidgetItem, QMessageBox, QSpacerItem
-from PyQt5.QtGui import QPixmap, QImage, QCursor, QImageReader, QIcon, QColor, QDesktopServices, QFont
-from PyQt5.QtCore import Qt, QDir, QSize, QPoint, QMutex, QUrl, QProcess, QSysInfo
-from PyQt5.QtCore import QItemSelectionModel, QItemSelection
+from PyQt5.QtWidgets import QLineEdit, QTextEdit, QMenu, QListView, QAction, QFileSystemModel, QTreeView, QTableView, QHeaderView, QProgressBar, QSpinBox
+from PyQt5.QtWidgets import QFileDialog, QDialog, QListWidget, QListWidgetItem, QMessageBox, QSpacerItem, QInputDialog, QStyledItemDelegate, QCompleter
+from PyQt5.QtGui import QPixmap, QImage, QCursor, QImageReader, QImageIOHandler, QIcon, QColor, QDesktopServices, QFont, QBrush, QKeySequence
+from PyQt5.QtCore import Qt, QDir, QSize, QPoint, QRect, QMutex, QUrl, QProcess, QSysInfo
+from PyQt5.QtCore import QObject, QRunnable, QThread, QThreadPool, QBuffer, QByteArray, QIODevice, QTimer, QFileSystemWatcher, QSettings
+from PyQt5.QtCore import QItemSelectionModel, QItemSelection, QAbstractListModel, QAbstractTableModel, QModelIndex, QStringListModel
 from PyQt5 import QtCore
 
+numpy = False # optional, vectorizes the selection math of the tag index and the near duplicate search, see import_numpy
+
+def import_numpy():
+    """numpy if it's installed, or None. It is imported on first use, at start up it would slow down every launch"""
+    global numpy
+    if numpy is False:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
 QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True) #enable highdpi scaling
 QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True) #use highdpi icons
 
@@ -32,9 +60,2107 @@ def hline(*widgets, **kwargs):
                 hbox.setStretch(i, p)
     return hbox
 
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class Span:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+class Instrumentation:
+    """Named timing spans around the hot paths, `with perf.span(name):` costs a single check while disabled"""
+    null_span = NullSpan()
+
+    def __init__(self, enabled=False, capacity=100000):
+        self.enabled = enabled
+        self.epoch = time.perf_counter()
+        self.events = deque(maxlen=capacity) # (name, start, duration, thread id)
+        self.recent = {} # {name: deque of recent durations}
+        self.counts = {} # {name: number of spans so far}
+        self.counters = {} # {name: function returning a dict of numbers, e.g. cache stats}
+
+    def span(self, name):
+        if not self.enabled:
+            return self.null_span
+        return Span(self, name)
+
+    def record(self, name, start, duration):
+        self.events.append((name, start, duration, threading.get_ident()))
+        recent = self.recent.get(name)
+        if recent is None:
+            recent = self.recent.setdefault(name, deque(maxlen=200))
+        recent.append(duration)
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def summary(self):
+        """{name: (count, last, mean, p95)} in seconds over the recent spans"""
+        result = {}
+        for name, recent in list(self.recent.items()):
+            durations = sorted(recent)
+            if durations:
+                result[name] = (self.counts.get(name, 0), recent[-1], sum(durations) / len(durations),
+                                durations[min(len(durations) - 1, int(len(durations) * 0.95))])
+        return result
+
+    def counter_values(self):
+        return {name: counter() for name, counter in list(self.counters.items())}
+
+    def export_trace(self, path):
+        """Write the recorded spans in the Chrome trace event format, viewable in chrome://tracing or Perfetto"""
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'ts': (start - self.epoch) * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': tid}
+                  for name, start, duration, tid in list(self.events)]
+        now = (time.perf_counter() - self.epoch) * 1e6
+        for name, values in self.counter_values().items():
+            events.append({'name': name, 'ph': 'C', 'ts': now, 'pid': pid,
+                           'args': {key: value for key, value in values.items() if isinstance(value, (int, float))}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+perf = Instrumentation(os.environ.get('LITTLETAGGER_PROFILE', '') not in ('', '0'))
+
+image_extensions = ('.png', '.jpg', '.jpeg')
+
+def sidecar_path(path):
+    return os.path.splitext(path)[0] + '.txt'
+
+def read_sidecar(tag_path):
+    """Read the comma separated tags of a sidecar file, raises FileNotFoundError if there's none"""
+    # bytes that aren't utf-8, from an older encoding, are kept as lone surrogates and written back unchanged
+    with perf.span('sidecar.read'), open(tag_path, encoding='utf-8', errors='surrogateescape') as f:
+        return [tag for tag in (tag.strip() for tag in f.read().split(',')) if tag]
+
+def write_sidecar(tag_path, tags):
+    """Write a sidecar atomically, through a temporary file that is renamed over the old one,
+    so a crash can't leave a truncated file behind"""
+    tmp_path = f'{tag_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        with open(fd, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            f.write(', '.join(tags))
+        try:
+            shutil.copymode(tag_path, tmp_path)
+        except OSError:
+            pass
+        os.replace(tmp_path, tag_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class TagWriter(QObject):
+    """Writes tags behind the GUI's back on a background thread, into the sidecars or into a TagDatabase,
+    repeated edits of an image that is still waiting are coalesced into one write"""
+    write_failed = QtCore.pyqtSignal(str, str) # tag_path, error
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.database = None
+        self.pending = {} # {image_path: tags}
+        self.writing = 0
+        self.in_flight = {} # {image_path: tags} being written
+        self.written = {} # {image_path: time.monotonic() its last write finished}
+        self.failed = {} # {tag_path: error}, until a later write of the same file succeeds
+        self.condition = threading.Condition()
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def write(self, path, tags):
+        with self.condition:
+            self.pending[path] = list(tags)
+            self.condition.notify_all()
+
+    def write_many(self, images):
+        """write() every {image_path: tags} under one lock, waking the worker once"""
+        with self.condition:
+            for path, tags in images.items():
+                self.pending[path] = list(tags)
+            self.condition.notify_all()
+
+    def superseded(self, paths, read_started):
+        """The paths with a write queued, running or finished since read_started, a time.monotonic(),
+        a sidecar read from then may predate that write"""
+        with self.condition:
+            written = self.written
+            return {path for path in paths if path in self.pending or path in self.in_flight or written.get(path, -math.inf) >= read_started}
+
+    def set_database(self, database):
+        """Write into database from now on, or into the sidecars if it's None"""
+        self.flush()
+        self.database = database
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is on disk, returns False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.writing, timeout)
+
+    def work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                batch = self.pending
+                self.pending = {}
+                self.writing = len(batch)
+                self.in_flight = batch
+                if len(self.written) > 65536:
+                    # a read started a minute ago has long been delivered
+                    cutoff = time.monotonic() - 60
+                    self.written = {path: finished for path, finished in self.written.items() if finished >= cutoff}
+            database = self.database
+            if database is not None:
+                try:
+                    with perf.span('database.write'):
+                        database.put_many(batch)
+                    error = None
+                except (OSError, sqlite3.Error) as e:
+                    error = str(e)
+                with self.condition:
+                    self.writing = 0
+                    self.in_flight = {}
+                    self.written.update(dict.fromkeys(batch, time.monotonic()))
+                    if error is None:
+                        self.failed.pop(database.path, None)
+                    else:
+                        self.failed[database.path] = error
+                    self.condition.notify_all()
+                if error is not None:
+                    self.write_failed.emit(database.path, error)
+                continue
+            for path, tags in batch.items():
+                tag_path = sidecar_path(path)
+                try:
+                    with perf.span('sidecar.write'):
+                        write_sidecar(tag_path, tags)
+                    error = None
+                except OSError as e:
+                    error = str(e)
+                with self.condition:
+                    self.writing -= 1
+                    self.written[path] = time.monotonic()
+                    if error is None:
+                        self.failed.pop(tag_path, None)
+                    else:
+                        self.failed[tag_path] = error
+                    self.condition.notify_all()
+                if error is not None:
+                    self.write_failed.emit(tag_path, error)
+            with self.condition:
+                self.in_flight = {}
+
+def apply_tag_changes(tags, added_tags, removed_tags):
+    """Return a copy of the tag list with added_tags appended and removed_tags taken out, keeping the order"""
+    tags = list(tags)
+    for tag in added_tags:
+        if tag not in tags:
+            tags.append(tag)
+    for tag in removed_tags:
+        if tag in tags:
+            tags.remove(tag)
+    return tags
+
+def rename_tags(tags, renames):
+    """Return a copy of the tag list with every tag in {old: new, or None to delete} renamed,
+    a renamed tag takes the place of the first of its names, keeping the order"""
+    return list(dict.fromkeys(renames.get(tag, tag) for tag in tags if renames.get(tag, tag)))
+
+def rename_tags_many(paths, renames, database=None, workers=16, progress=None):
+    """Read the tags of every image of paths from its sidecar, or from the database, and rename them,
+    returns {image_path: (old tags, new tags)} of the images that change"""
+    def read(path):
+        try:
+            return path, read_sidecar(sidecar_path(path))
+        except OSError:
+            return path, None
+
+    changes = {}
+    with ThreadPoolExecutor(workers) as executor:
+        if database is not None:
+            stored = database.load()
+            results = ((path, stored.get(path)) for path in paths)
+        else:
+            results = (future.result() for future in imap_unordered_bounded(executor, read, ((path,) for path in paths), workers * 4))
+        for num_done, (path, old_tags) in enumerate(results, 1):
+            if old_tags:
+                new_tags = rename_tags(old_tags, renames)
+                if new_tags != old_tags:
+                    changes[path] = (old_tags, new_tags)
+            if progress and num_done % 256 == 0:
+                progress(num_done, len(paths))
+    return changes
+
+def write_tags_many(images, database=None, workers=16, progress=None, expected=None):
+    """Write {image_path: tags} into the sidecars on a thread pool, or into the database in one go,
+    with expected {image_path: tags} only over the images still carrying those.
+    Returns {tag_path: error} of the sidecars that failed or changed meanwhile"""
+    if database is not None:
+        changed = {}
+        if expected is not None:
+            stored = database.load()
+            changed = {sidecar_path(path): 'changed since it was read' for path in images if stored.get(path) != list(expected[path])}
+            images = {path: tags for path, tags in images.items() if sidecar_path(path) not in changed}
+        database.put_many(images)
+        return changed
+
+    def write(path, tags):
+        tag_path = sidecar_path(path)
+        try:
+            if expected is not None and read_sidecar(tag_path) != list(expected[path]):
+                return tag_path, 'changed since it was read'
+            write_sidecar(tag_path, tags)
+        except OSError as e:
+            return tag_path, str(e)
+        return tag_path, None
+
+    failed = {}
+    with ThreadPoolExecutor(workers) as executor:
+        for num_done, future in enumerate(imap_unordered_bounded(executor, write, images.items(), workers * 4), 1):
+            tag_path, error = future.result()
+            if error:
+                failed[tag_path] = error
+            if progress and num_done % 256 == 0:
+                progress(num_done, len(images))
+    return failed
+
+def tag_journal_dir(directory):
+    return os.path.join(directory, '.littletagger-journal')
+
+def write_tag_journal(directory, description, changes):
+    """Record {image_path: (old tags, new tags)} of a bulk edit before it is made, a description line first,
+    then one json line per image. Returns the journal path"""
+    journal_dir = tag_journal_dir(directory)
+    os.makedirs(journal_dir, exist_ok=True)
+    # the names sort in the order the edits were made
+    now = time.time_ns()
+    journal_path = os.path.join(journal_dir, time.strftime('%Y%m%d-%H%M%S', time.localtime(now // 10**9)) + f'-{now % 10**9:09d}.jsonl')
+    with open(journal_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'description': description, 'images': len(changes)}) + '\n')
+        for path, (old_tags, new_tags) in changes.items():
+            f.write(json.dumps({'path': path, 'old': list(old_tags), 'new': list(new_tags)}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    return journal_path
+
+def read_tag_journal(journal_path):
+    """Return (description, [(image_path, old tags, new tags)])"""
+    with open(journal_path, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        return header['description'], [(entry['path'], entry['old'], entry['new']) for entry in map(json.loads, f)]
+
+def latest_tag_journal(directory):
+    """The journal of the last bulk edit that wasn't undone yet, or None"""
+    try:
+        names = [name for name in os.listdir(tag_journal_dir(directory)) if name.endswith('.jsonl')]
+    except OSError:
+        return None
+    return os.path.join(tag_journal_dir(directory), max(names)) if names else None
+
+def to_sqlite_text(text):
+    """sqlite refuses the lone surrogates undecodable sidecar bytes are read into, such text is stored as its bytes"""
+    try:
+        text.encode('utf-8')
+        return text
+    except UnicodeEncodeError:
+        return text.encode('utf-8', 'surrogateescape')
+
+def from_sqlite_text(value):
+    return value.decode('utf-8', 'surrogateescape') if isinstance(value, bytes) else value
+
+def tag_database_path(directory):
+    return os.path.join(directory, '.littletagger.sqlite')
+
+class TagDatabase:
+    """Optional single file tag store of a dataset, used instead of the sidecars while it exists,
+    so opening a dataset is one query instead of a small read per image"""
+
+    def __init__(self, directory, path=None):
+        self.root = directory.rstrip('/\\')
+        self.path = path or tag_database_path(directory)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tags (path TEXT PRIMARY KEY, tags TEXT)')
+        self.db.commit()
+
+    def relative(self, path):
+        if path.startswith(self.root + '/'):
+            return path[len(self.root)+1:]
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def load(self):
+        """Return {image_path: tags} of every image in the store"""
+        with self.lock:
+            rows = self.db.execute('SELECT path, tags FROM tags').fetchall()
+        prefix = self.root + '/'
+        return {prefix + from_sqlite_text(path): [tag.strip() for tag in from_sqlite_text(tags).split(',') if tag.strip()] for path, tags in rows}
+
+    def put_many(self, items):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO tags VALUES (?, ?)',
+                                ((to_sqlite_text(self.relative(path)), to_sqlite_text(', '.join(tags))) for path, tags in items.items()))
+            self.db.commit()
+
+    def import_sidecars(self, workers=16, progress=None):
+        """Read every sidecar under the dataset into the store, returns the number of images"""
+        num_done = 0
+        batch = {}
+        with ThreadPoolExecutor(workers) as executor:
+            for future in imap_unordered_bounded(executor, lambda path, tag_path: (path, stat_and_read_sidecar(tag_path)[1]),
+                                                 scan_images(self.root), workers * 4):
+                path, tags = future.result()
+                batch[path] = tags
+                num_done += 1
+                if len(batch) >= 4096:
+                    self.put_many(batch)
+                    batch = {}
+                    if progress:
+                        progress(num_done, 0)
+        self.put_many(batch)
+        return num_done
+
+    def export_sidecars(self, workers=16, progress=None):
+        """Write every image's tags back into its sidecar, returns the number of files written"""
+        items = self.load()
+
+        def export(path, tags):
+            tag_path = sidecar_path(path)
+            # an untagged image without a sidecar doesn't get an empty one, one whose tags were all removed does
+            if not tags and not os.path.exists(tag_path):
+                return False
+            write_sidecar(tag_path, tags)
+            return True
+
+        num_done = 0
+        with ThreadPoolExecutor(workers) as executor:
+            for num_seen, future in enumerate(imap_unordered_bounded(executor, export, items.items(), workers * 4), 1):
+                num_done += future.result()
+                if progress and num_seen % 1024 == 0:
+                    progress(num_seen, len(items))
+        return num_done
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class BackgroundTask(QObject):
+    """Runs function(progress) on a thread, progress(done, total) and the result come back as signals"""
+    progress = QtCore.pyqtSignal(int, int)
+    finished = QtCore.pyqtSignal(object) # result, or the exception that was raised
+
+    def __init__(self, function, parent=None):
+        super().__init__(parent)
+        self.function = function
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            result = self.function(self.progress.emit)
+        except Exception as e:
+            result = e
+        self.finished.emit(result)
+
+def scan_folder(folder, recursive=True):
+    """List one folder with os.scandir, returns ([(image_path, tag_path or None)], [subfolders])"""
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return [], []
+    names = set()
+    images = []
+    subfolders = []
+    for entry in entries:
+        names.add(entry.name)
+        try:
+            if entry.is_dir():
+                if recursive and not entry.name.startswith('.'):
+                    subfolders.append(entry.path if os.sep == '/' else entry.path.replace(os.sep, '/'))
+            elif entry.name.lower().endswith(image_extensions):
+                images.append(entry)
+        except OSError:
+            continue
+    result = []
+    for entry in images:
+        path = entry.path if os.sep == '/' else entry.path.replace(os.sep, '/')
+        tag_name = os.path.splitext(entry.name)[0] + '.txt'
+        result.append((path, sidecar_path(path) if tag_name in names else None))
+    return result, subfolders
+
+def scan_images(directory, recursive=True):
+    """Yield (image_path, tag_path or None) for every image under directory, using os.scandir"""
+    stack = [directory]
+    while stack:
+        images, subfolders = scan_folder(stack.pop(), recursive)
+        stack.extend(subfolders)
+        yield from images
+
+def stat_and_read_sidecar(tag_path, known=None):
+    """Return ((mtime, size), tags) of a sidecar, or (None, ()) if it can't be read.
+    known is the ((mtime, size), tags) of an earlier read, its tags are returned without reading the file if it didn't change"""
+    if tag_path is None:
+        return None, ()
+    try:
+        st = os.stat(tag_path)
+        stat = (st.st_mtime_ns, st.st_size)
+        if known is not None and known[0] == stat:
+            return known
+        return stat, read_sidecar(tag_path)
+    except OSError:
+        return None, ()
+
+def tag_snapshot_path(directory):
+    name = hashlib.sha1(directory.rstrip('/\\').encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(default_cache_dir(), 'sessions', f'{name}.jsonl')
+
+def write_tag_snapshot(snapshot_path, folders):
+    """Write {folder: [(image_path, (mtime, size) of the sidecar, tags)]} atomically, one json line per folder"""
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    tmp_path = f'{snapshot_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for folder, images in folders.items():
+            start = len(folder) + 1
+            f.write(json.dumps([folder, [(path[start:], *stat, tags) for path, stat, tags in images]]) + '\n')
+    os.replace(tmp_path, snapshot_path)
+
+def read_tag_snapshot(snapshot_path):
+    """Return {image_path: ((mtime, size), tags)} of a snapshot, empty if there's none or it can't be read"""
+    known = {}
+    try:
+        with open(snapshot_path, encoding='utf-8') as f:
+            # a line at a time, so the reading thread lets go of the GIL in between
+            for line in f:
+                folder, images = json.loads(line)
+                for name, mtime, size, tags in images:
+                    known[f'{folder}/{name}'] = ((mtime, size), tags)
+    except (OSError, ValueError):
+        return {}
+    return known
+
+class TagScanner(QObject):
+    """Loads every sidecar under a directory in the background, then keeps watching it,
+    through QFileSystemWatcher for created / renamed / deleted files and through polling for in place edits"""
+    tags_loaded = QtCore.pyqtSignal(int, float, dict) # generation, time.monotonic() the reads started, {image_path: tags, or None if the image is gone}
+    progress = QtCore.pyqtSignal(int, int)
+    finished = QtCore.pyqtSignal(int) # generation
+    batch_size = 512
+    min_poll_interval = 5000
+    max_queued = 4 # batches on their way to the GUI thread before the readers wait for it to catch up
+
+    def __init__(self, parent=None, num_readers=16):
+        super().__init__(parent)
+        self.directory = None
+        self.generation = 0
+        self.complete = False # every sidecar of directory was handed to the GUI thread
+        self.last_scan_seconds = 0
+        self.folders = {} # {folder: {image_path: sidecar (mtime, size) or None}}
+        self.known = {} # {image_path: (sidecar (mtime, size), tags)} from a snapshot, while a scan runs
+        self.readers = ThreadPoolExecutor(num_readers)
+        # a burst of queued batches would be handled in one go, freezing the GUI until all are indexed
+        self.queued = threading.Semaphore(self.max_queued)
+        self.tags_loaded.connect(lambda generation, started, batch: self.queued.release())
+        self.tasks = queue.Queue()
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.on_directory_changed)
+        self.poll_timer = QTimer(self)
+        self.poll_timer.setSingleShot(True)
+        self.poll_timer.timeout.connect(lambda: self.tasks.put((self.generation, 'rescan', None)))
+        self.finished.connect(self.on_finished)
+
+    def start(self, directory, snapshot_path=None):
+        """Scan directory, the sidecars that didn't change since the snapshot was written are taken from it instead of read"""
+        self.stop()
+        self.directory = directory
+        self.tasks.put((self.generation, 'scan', (directory, snapshot_path)))
+
+    def stop(self):
+        self.generation += 1
+        self.complete = False
+        self.poll_timer.stop()
+        if self.watcher.directories():
+            self.watcher.removePaths(self.watcher.directories())
+
+    def load(self, images):
+        """Read the sidecars of [(image_path, tag_path)] on the reader pool, outside of any scan"""
+        generation = self.generation
+
+        def read():
+            started, results = self.read_batch(images)
+            self.emit_batch(generation, started, {path: tags for path, _, _, tags in results})
+        self.readers.submit(read)
+
+    def emit_batch(self, generation, started, batch):
+        """Hand batch to the GUI thread, tagged with its generation since batches already queued outlive a stop()"""
+        self.queued.acquire()
+        if generation != self.generation:
+            # stopped while waiting for the GUI thread to catch up
+            self.queued.release()
+            return
+        self.tags_loaded.emit(generation, started, batch)
+
+    def on_directory_changed(self, folder):
+        self.tasks.put((self.generation, 'rescan', [folder]))
+
+    def on_finished(self, generation):
+        if generation != self.generation:
+            return
+        self.complete = True
+        # watch what got scanned, then poll for edits the watcher can't see
+        if self.watcher.directories():
+            self.watcher.removePaths(self.watcher.directories())
+        folders = list(self.folders)
+        if folders:
+            self.watcher.addPaths(folders)
+        self.poll_timer.start(max(self.min_poll_interval, int(self.last_scan_seconds * 10000)))
+
+    def work(self):
+        while True:
+            generation, task, arg = self.tasks.get()
+            if generation != self.generation:
+                continue
+            started = time.perf_counter()
+            if task == 'scan':
+                self.scan(generation, *arg)
+            elif task == 'rescan':
+                self.rescan(generation, arg)
+            self.last_scan_seconds = time.perf_counter() - started
+            if generation == self.generation and (task == 'scan' or arg is None):
+                self.finished.emit(generation)
+
+    def read_batch(self, images):
+        """Returns (time.monotonic() the reads started, [(image_path, tag_path, sidecar (mtime, size), tags)])"""
+        known = self.known
+        started = time.monotonic()
+        return started, [(path, tag_path) + stat_and_read_sidecar(tag_path, known.get(path)) for path, tag_path in images]
+
+    def scan(self, generation, directory, snapshot_path=None):
+        self.folders = {}
+        if snapshot_path is not None:
+            with perf.span('scan.snapshot'):
+                self.known = read_tag_snapshot(snapshot_path)
+        try:
+            self.walk(generation, directory)
+        finally:
+            self.known = {}
+
+    def walk(self, generation, directory):
+        pending = []
+        num_found = num_done = 0
+        stack = [directory]
+        while stack and generation == self.generation:
+            folder = stack.pop()
+            images, subfolders = scan_folder(folder)
+            stack.extend(subfolders)
+            self.folders[folder] = {}
+            for start in range(0, len(images), self.batch_size):
+                pending.append((folder, self.readers.submit(self.read_batch, images[start:start+self.batch_size])))
+            num_found += len(images)
+            # hand over finished reads while the walk goes on
+            while pending and (pending[0][1].done() or len(pending) > 64):
+                num_done += self.deliver(generation, *pending.pop(0))
+                self.progress.emit(num_done, num_found)
+        for folder, future in pending:
+            if generation != self.generation:
+                future.cancel()
+                continue
+            num_done += self.deliver(generation, folder, future)
+            self.progress.emit(num_done, num_found)
+
+    def deliver(self, generation, folder, future):
+        batch = {}
+        stats = self.folders.setdefault(folder, {})
+        started, results = future.result()
+        for path, tag_path, stat, tags in results:
+            stats[path] = stat
+            batch[path] = tags
+        self.emit_batch(generation, started, batch)
+        return len(results)
+
+    def snapshot(self, tag_cache, skip=()):
+        """{folder: [(image_path, sidecar (mtime, size), tags)]} of the sidecars seen by the last scan, for write_tag_snapshot.
+        Leaves out the sidecars in skip, and the images tag_cache doesn't have"""
+        folders = {}
+        for folder, stats in list(self.folders.items()):
+            images = []
+            for path, stat in list(stats.items()):
+                if stat is not None and not (skip and sidecar_path(path) in skip):
+                    tags = tag_cache.get(path)
+                    if tags is not None:
+                        images.append((path, stat, tags))
+            if images:
+                folders[folder] = images
+        return folders
+
+    def rescan(self, generation, folders):
+        """Re-read the sidecars that were created, changed or deleted since the last look"""
+        for folder in list(self.folders) if folders is None else folders:
+            if generation != self.generation or folder not in self.folders:
+                continue
+            started = time.monotonic()
+            images, _ = scan_folder(folder, False)
+            old_stats = self.folders[folder]
+            new_stats = {}
+            batch = {}
+            changed = []
+            for path, tag_path in images:
+                try:
+                    st = os.stat(tag_path) if tag_path else None
+                except OSError:
+                    st = None
+                new_stats[path] = (st.st_mtime_ns, st.st_size) if st else None
+                if path not in old_stats or old_stats[path] != new_stats[path]:
+                    changed.append((path, tag_path))
+            for path, tag_path, stat, tags in self.read_batch(changed)[1]:
+                new_stats[path] = stat
+                batch[path] = tags
+            for path in old_stats.keys() - new_stats.keys():
+                batch[path] = None
+            self.folders[folder] = new_stats
+            if batch:
+                self.emit_batch(generation, started, batch)
+
+class TagIndex:
+    """Inverted index from each tag to the images carrying it, also behaves like a {image_path: (tags in sidecar order)} dict.
+    Tags are interned to integer ids and images numbered by row, an image keeps an array of its tag ids and a tag
+    a sorted array of its rows, so a tag of an image takes 4 bytes each way. With numpy the selection math runs
+    vectorized on those arrays, without copying them, once there are numpy_rows images"""
+    numpy_rows = 1024 # fewer images are handled in plain python, numpy needn't even be imported for them
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.tag_ids = {} # {tag: id}
+        self.tag_names = [] # [tag] by id
+        self.tag_rows = [] # [array of the sorted rows carrying the tag] by id
+        self.rows = {} # {image_path: row}
+        self.paths = [] # [image_path, or None once discarded] by row
+        self.row_tags = [] # [array of tag ids in sidecar order, or None once discarded] by row
+        self.live = bytearray() # 1 by row while the image is in the index
+
+    def intern(self, tag):
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = self.tag_ids[tag] = len(self.tag_names)
+            self.tag_names.append(tag)
+            self.tag_rows.append(array('I'))
+        return tag_id
+
+    def names(self, tag_ids):
+        names = self.tag_names
+        return tuple(names[tag_id] for tag_id in tag_ids)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, path):
+        return path in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, path):
+        return self.names(self.row_tags[self.rows[path]])
+
+    def __setitem__(self, path, tags):
+        self.set(path, tags)
+
+    def _row_and_ids(self, path, tags):
+        """(row of the image, added if it's new, array of its interned tag ids)"""
+        get = self.tag_ids.get
+        tag_ids = [get(tag) for tag in tags]
+        if None in tag_ids:
+            tag_ids = [self.intern(tag) for tag in tags]
+        row = self.rows.get(path)
+        if row is None:
+            row = self.rows[path] = len(self.paths)
+            self.paths.append(path)
+            self.row_tags.append(array('I'))
+            self.live.append(1)
+        return row, array('I', dict.fromkeys(tag_ids))
+
+    def set(self, path, tags):
+        """Set the tags of an image, returns the tags no image carried before, or None if nothing changed"""
+        row, tag_ids = self._row_and_ids(path, tags)
+        if self.row_tags[row] == tag_ids:
+            return None
+        old_set = set(self.row_tags[row])
+        new_set = set(tag_ids)
+        for tag_id in old_set - new_set:
+            self._unlink(tag_id, row)
+        tag_rows = self.tag_rows
+        appeared = [self.tag_names[tag_id] for tag_id in new_set - old_set if not tag_rows[tag_id]]
+        for tag_id in new_set - old_set:
+            self._link(tag_id, row)
+        self.row_tags[row] = tag_ids
+        return appeared
+
+    def set_many(self, images):
+        """set() every {image_path: tags}, the rows a tag gains or loses are merged into its array in one go,
+        instead of an insertion or deletion each. Returns the tags no image carried before"""
+        linked = {} # {tag_id: [rows]}
+        unlinked = {}
+        for path, tags in images.items():
+            row, tag_ids = self._row_and_ids(path, tags)
+            old_tag_ids = self.row_tags[row]
+            if old_tag_ids == tag_ids:
+                continue
+            old_set = set(old_tag_ids)
+            new_set = set(tag_ids)
+            for tag_id in old_set - new_set:
+                unlinked.setdefault(tag_id, []).append(row)
+            for tag_id in new_set - old_set:
+                linked.setdefault(tag_id, []).append(row)
+            self.row_tags[row] = tag_ids
+        tag_rows = self.tag_rows
+        appeared = [self.tag_names[tag_id] for tag_id in linked if not tag_rows[tag_id]]
+        for tag_id, rows in unlinked.items():
+            gone = set(rows)
+            tag_rows[tag_id] = array('I', [row for row in tag_rows[tag_id] if row not in gone])
+        for tag_id, rows in linked.items():
+            rows.sort()
+            tag_rows[tag_id] = array('I', heapq.merge(tag_rows[tag_id], rows))
+        return appeared
+
+    def __delitem__(self, path):
+        row = self.rows.pop(path)
+        for tag_id in self.row_tags[row]:
+            self._unlink(tag_id, row)
+        self.paths[row] = None
+        self.row_tags[row] = None
+        self.live[row] = 0
+
+    def _link(self, tag_id, row):
+        rows = self.tag_rows[tag_id]
+        if not rows or rows[-1] < row:
+            # images are mostly added in order, to the end
+            rows.append(row)
+        else:
+            rows.insert(bisect.bisect_left(rows, row), row)
+
+    def _unlink(self, tag_id, row):
+        rows = self.tag_rows[tag_id]
+        del rows[bisect.bisect_left(rows, row)]
+
+    def get(self, path, default=None):
+        row = self.rows.get(path)
+        return default if row is None else self.names(self.row_tags[row])
+
+    def values(self):
+        return (self.names(tag_ids) for tag_ids in self.row_tags if tag_ids is not None)
+
+    def items(self):
+        return ((path, self.names(self.row_tags[row])) for path, row in self.rows.items())
+
+    def discard(self, path):
+        if path in self.rows:
+            del self[path]
+
+    def tags(self):
+        return [tag for tag, rows in zip(self.tag_names, self.tag_rows) if rows]
+
+    def count(self, tag):
+        tag_id = self.tag_ids.get(tag)
+        return 0 if tag_id is None else len(self.tag_rows[tag_id])
+
+    def counts(self):
+        return {tag: len(rows) for tag, rows in zip(self.tag_names, self.tag_rows) if rows}
+
+    def tag_count(self, path):
+        row = self.rows.get(path)
+        return 0 if row is None else len(self.row_tags[row])
+
+    def paths_with(self, tag):
+        tag_id = self.tag_ids.get(tag)
+        return set() if tag_id is None else {self.paths[row] for row in self.tag_rows[tag_id]}
+
+    # the row sets below are numpy bool masks by row if _numpy() is there, python sets of rows otherwise
+
+    def _numpy(self):
+        return import_numpy() if len(self.paths) >= self.numpy_rows else None
+
+    def _rows_with(self, tag):
+        tag_id = self.tag_ids.get(tag)
+        rows = self.tag_rows[tag_id] if tag_id is not None else array('I')
+        numpy = self._numpy()
+        if numpy is None:
+            return set(rows)
+        mask = numpy.zeros(len(self.paths), dtype=bool)
+        if rows:
+            mask[numpy.frombuffer(rows, dtype=numpy.uintc)] = True
+        return mask
+
+    def _all_rows(self):
+        numpy = self._numpy()
+        if numpy is None:
+            return set(self.rows.values())
+        return numpy.frombuffer(self.live, dtype=bool).copy() if self.live else numpy.zeros(0, dtype=bool)
+
+    def _rows_of(self, paths):
+        rows = [self.rows[path] for path in paths if path in self.rows]
+        numpy = self._numpy()
+        if numpy is None:
+            return set(rows)
+        mask = numpy.zeros(len(self.paths), dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def _paths_of(self, rows):
+        if not isinstance(rows, set):
+            rows = numpy.flatnonzero(rows).tolist()
+        return {self.paths[row] for row in rows}
+
+    def _difference(self, rows, other):
+        return rows - other if isinstance(rows, set) else rows & ~other
+
+    def query(self, all_of=(), any_of=(), none_of=()):
+        """Images carrying all tags of all_of, at least one of any_of and none of none_of"""
+        result = self._all_rows()
+        for tag in all_of:
+            result &= self._rows_with(tag)
+        if any_of:
+            matches = self._rows_of(())
+            for tag in any_of:
+                matches |= self._rows_with(tag)
+            result &= matches
+        for tag in none_of:
+            result = self._difference(result, self._rows_with(tag))
+        return self._paths_of(result)
+
+    def histogram(self, paths):
+        """{tag: number of the images of paths carrying it}, for the tags at least one of them carries"""
+        rows = [self.rows[path] for path in paths if path in self.rows]
+        numpy = import_numpy() if len(rows) >= self.numpy_rows else None
+        if numpy is None:
+            # few images, count their own tags
+            counts = Counter()
+            for row in rows:
+                counts.update(self.row_tags[row])
+            return {self.tag_names[tag_id]: count for tag_id, count in counts.items()}
+        # many, gather their tag ids into one flat array and count them all in one go
+        flat = array('I')
+        row_tags = self.row_tags
+        for row in rows:
+            flat.extend(row_tags[row])
+        counts = numpy.bincount(numpy.frombuffer(flat, dtype=numpy.uintc), minlength=len(self.tag_names))
+        names = self.tag_names
+        return {names[tag_id]: int(counts[tag_id]) for tag_id in numpy.flatnonzero(counts).tolist()}
+
+    def evaluate(self, expression):
+        """Evaluate a tag expression like `a & (b | c) & !d`, `,` works as `&`"""
+        tokens = []
+        token = ''
+        for ch in expression:
+            if ch in '&|!(),':
+                if token.strip():
+                    tokens.append(token.strip())
+                tokens.append('&' if ch == ',' else ch)
+                token = ''
+            else:
+                token += ch
+        if token.strip():
+            tokens.append(token.strip())
+        pos = 0
+
+        def peek():
+            return tokens[pos] if pos < len(tokens) else None
+
+        def parse_or():
+            nonlocal pos
+            result = parse_and()
+            while peek() == '|':
+                pos += 1
+                result = result | parse_and()
+            return result
+
+        def parse_and():
+            nonlocal pos
+            result = parse_not()
+            while peek() == '&':
+                pos += 1
+                result = result & parse_not()
+            return result
+
+        def parse_not():
+            nonlocal pos
+            token = peek()
+            if token is None:
+                raise ValueError(f'unexpected end of expression: {expression}')
+            pos += 1
+            if token == '!':
+                return self._difference(self._all_rows(), parse_not())
+            if token == '(':
+                result = parse_or()
+                if peek() != ')':
+                    raise ValueError(f'missing ")" in expression: {expression}')
+                pos += 1
+                return result
+            if token in '&|)':
+                raise ValueError(f'unexpected "{token}" in expression: {expression}')
+            return self._rows_with(token)
+
+        result = parse_or()
+        if pos != len(tokens):
+            raise ValueError(f'unexpected "{tokens[pos]}" in expression: {expression}')
+        return self._paths_of(result)
+
+class SelectionTags:
+    """The images of a selection and how many of them carry each tag, so the selection can grow and shrink
+    a range at a time, also behaves like a {image_path: imagerecord} dict"""
+
+    def __init__(self):
+        self.images = {} # {image_path: imagerecord}
+        self.counts = Counter() # {tag: number of selected images carrying it}
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, path):
+        return path in self.images
+
+    def __iter__(self):
+        return iter(self.images)
+
+    def __getitem__(self, path):
+        return self.images[path]
+
+    def keys(self):
+        return self.images.keys()
+
+    def values(self):
+        return self.images.values()
+
+    def add(self, record):
+        """Add an image, or replace the tags of one already in the selection"""
+        self.remove(record.path)
+        self.images[record.path] = record
+        self.counts.update(set(record.tags))
+
+    def add_many(self, records, counts=None):
+        """Add images, counts is their {tag: number of images} if it's already known"""
+        if counts is None:
+            for record in records:
+                self.add(record)
+            return
+        for record in records:
+            self.remove(record.path)
+            self.images[record.path] = record
+        self.counts.update(counts)
+
+    def change_common(self, images, added_tags, removed_tags):
+        """Replace the tags of the selected {image_path: tags} after added_tags were added to every selected image
+        and removed_tags taken out of every one, the counts of those follow without a recount"""
+        for path, tags in images.items():
+            record = self.images[path]
+            self.images[path] = ImageRecord(path, record.tag_path, tags)
+        for tag in added_tags:
+            self.counts[tag] = len(self.images)
+        for tag in removed_tags:
+            self.counts.pop(tag, None)
+
+    def remove(self, path):
+        record = self.images.pop(path, None)
+        if record is None:
+            return
+        for tag in set(record.tags):
+            self.counts[tag] -= 1
+            if not self.counts[tag]:
+                del self.counts[tag]
+
+    def clear(self):
+        self.images.clear()
+        self.counts.clear()
+
+    def common(self):
+        """Tags every selected image carries"""
+        return {tag for tag, count in self.counts.items() if count == len(self.images)}
+
+    def partial(self, tag):
+        """Number of selected images carrying tag if only some of them do, else None"""
+        count = self.counts.get(tag, 0)
+        return count if 0 < count < len(self.images) else None
+
+class TagListModel(QAbstractListModel):
+    """List of tags with hashed membership, optionally kept sorted by inserting at the bisected row"""
+
+    def __init__(self, parent=None, keep_sorted=False):
+        super().__init__(parent)
+        self.keep_sorted = keep_sorted
+        self.tags = []
+        self.members = {} # {tag: number of rows}, rows can repeat for a moment while being dragged around
+        self.merged = None # the new tags while add_many resets the model with them, so a listener needn't start over
+
+    def __contains__(self, tag):
+        return tag in self.members
+
+    def __len__(self):
+        return len(self.tags)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.tags)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role in (Qt.DisplayRole, Qt.EditRole):
+            return self.tags[index.row()]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemIsDropEnabled
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsDragEnabled
+
+    def supportedDropActions(self):
+        return Qt.MoveAction
+
+    def _link(self, tag):
+        self.members[tag] = self.members.get(tag, 0) + 1
+
+    def _unlink(self, tag):
+        if self.members.get(tag, 0) > 1:
+            self.members[tag] -= 1
+        else:
+            self.members.pop(tag, None)
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.EditRole:
+            return False
+        self._unlink(self.tags[index.row()])
+        self.tags[index.row()] = value
+        self._link(value)
+        self.dataChanged.emit(index, index)
+        return True
+
+    def insertRows(self, row, count, parent=QModelIndex()):
+        self.beginInsertRows(parent, row, row + count - 1)
+        self.tags[row:row] = [''] * count
+        for _ in range(count):
+            self._link('')
+        self.endInsertRows()
+        return True
+
+    def removeRows(self, row, count, parent=QModelIndex()):
+        if row < 0 or row + count > len(self.tags):
+            return False
+        self.beginRemoveRows(parent, row, row + count - 1)
+        for tag in self.tags[row:row+count]:
+            self._unlink(tag)
+        del self.tags[row:row+count]
+        self.endRemoveRows()
+        return True
+
+    def moveRows(self, source_parent, source_row, count, destination_parent, destination_row):
+        if destination_row in range(source_row, source_row + count + 1):
+            return False
+        if not self.beginMoveRows(source_parent, source_row, source_row + count - 1, destination_parent, destination_row):
+            return False
+        moved = self.tags[source_row:source_row+count]
+        del self.tags[source_row:source_row+count]
+        if destination_row > source_row:
+            destination_row -= count
+        self.tags[destination_row:destination_row] = moved
+        self.endMoveRows()
+        return True
+
+    def row_of(self, tag):
+        if tag not in self.members:
+            return -1
+        if self.keep_sorted:
+            return bisect.bisect_left(self.tags, tag)
+        return self.tags.index(tag)
+
+    def add(self, tag):
+        """Add a tag unless it's there already, returns whether it was added"""
+        if tag in self.members:
+            return False
+        row = bisect.bisect_left(self.tags, tag) if self.keep_sorted else len(self.tags)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.tags.insert(row, tag)
+        self._link(tag)
+        self.endInsertRows()
+        return True
+
+    def add_many(self, tags):
+        new_tags = {tag for tag in tags if tag not in self.members}
+        if len(new_tags) > 64:
+            # cheaper to merge once than to shift the list for every insertion
+            self.merged = new_tags
+            try:
+                self.set_tags(self.tags + list(new_tags))
+            finally:
+                self.merged = None
+        else:
+            for tag in sorted(new_tags) if self.keep_sorted else new_tags:
+                self.add(tag)
+
+    def remove(self, tag):
+        row = self.row_of(tag)
+        if row >= 0:
+            self.removeRows(row, 1)
+
+    def remove_rows(self, rows):
+        for row in sorted(set(rows), reverse=True):
+            self.removeRows(row, 1)
+
+    def set_tags(self, tags):
+        self.beginResetModel()
+        self.tags = sorted(set(tags)) if self.keep_sorted else list(dict.fromkeys(tags))
+        self.members = dict.fromkeys(self.tags, 1)
+        self.endResetModel()
+
+    def clear(self):
+        self.set_tags([])
+
+class DatasetModel(QAbstractTableModel):
+    """Flat, sortable table of the image files under a directory, listed by an os.scandir walk on a thread,
+    with the row of a path a dict lookup away. Answers the QFileSystemModel calls the tagger makes"""
+    columns = ['Name', 'Folder', 'Tags']
+    NAME, FOLDER, TAGS = range(3)
+    batch_size = 4096
+    paths_found = QtCore.pyqtSignal(int, list) # generation, [image_path]
+    walk_finished = QtCore.pyqtSignal(int) # generation
+
+    def __init__(self, parent=None, tag_count=None):
+        super().__init__(parent)
+        self.tag_count = tag_count or (lambda path: 0)
+        self.root = None
+        self.recursive = False
+        self.generation = 0
+        self.walking = False
+        self.sort_column = None
+        self.sort_order = Qt.AscendingOrder
+        self.paths = []
+        self.rows = {} # {image_path: row}
+        self.paths_found.connect(self.on_paths_found)
+        self.walk_finished.connect(self.on_walk_finished)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.columns[section]
+        return None
+
+    def index(self, row_or_path, column=0, parent=QModelIndex()):
+        """index(row, column) like any model, or index(path) like QFileSystemModel"""
+        if isinstance(row_or_path, str):
+            row = self.rows.get(row_or_path.replace(os.sep, '/'))
+            return QModelIndex() if row is None else self.createIndex(row, 0)
+        # views ask for every row on a relayout, skip the rowCount / columnCount round trips of the base class
+        if parent.isValid() or not (0 <= row_or_path < len(self.paths) and 0 <= column < len(self.columns)):
+            return QModelIndex()
+        return self.createIndex(row_or_path, column)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        path = self.paths[index.row()]
+        if role == Qt.DisplayRole:
+            return self.column_value(path, index.column())
+        if role == Qt.ToolTipRole:
+            return path
+        if role == Qt.TextAlignmentRole and index.column() == self.TAGS:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def column_value(self, path, column):
+        if column == self.NAME:
+            return path.rsplit('/', 1)[-1]
+        if column == self.FOLDER:
+            folder = path.rsplit('/', 1)[0]
+            return folder[len(self.root) + 1:] if folder != self.root else ''
+        return self.tag_count(path)
+
+    def filePath(self, index):
+        return self.paths[index.row()] if index.isValid() else ''
+
+    def fileName(self, index):
+        return self.paths[index.row()].rsplit('/', 1)[-1] if index.isValid() else ''
+
+    def start(self, directory, recursive=False):
+        """List the images under directory in the background, rows come in batches as they are found"""
+        self.generation += 1
+        self.root = directory.replace(os.sep, '/').rstrip('/')
+        self.recursive = recursive
+        self.beginResetModel()
+        self.paths = []
+        self.rows = {}
+        self.endResetModel()
+        self.walking = True
+        threading.Thread(target=self.walk, args=(self.generation, self.root, recursive), daemon=True).start()
+
+    def stop(self):
+        self.generation += 1
+        self.walking = False
+
+    def walk(self, generation, directory, recursive):
+        stack = [directory]
+        while stack and generation == self.generation:
+            images, subfolders = scan_folder(stack.pop(), recursive)
+            stack.extend(sorted(subfolders, reverse=True))
+            for start in range(0, len(images), self.batch_size):
+                self.paths_found.emit(generation, [path for path, _ in images[start:start+self.batch_size]])
+        self.walk_finished.emit(generation)
+
+    def on_paths_found(self, generation, paths):
+        if generation == self.generation:
+            self.add_paths(paths)
+
+    def on_walk_finished(self, generation):
+        if generation == self.generation:
+            self.walking = False
+            if self.sort_column is not None:
+                self.sort(self.sort_column, self.sort_order)
+
+    def contains(self, path):
+        """Whether path belongs in the listing, it doesn't have to be found yet"""
+        if self.root is None:
+            return False
+        folder = path.rsplit('/', 1)[0]
+        return folder == self.root or (self.recursive and folder.startswith(self.root + '/'))
+
+    def add_paths(self, paths):
+        paths = [path for path in dict.fromkeys(paths) if path not in self.rows]
+        if not paths:
+            return
+        # appended at the end, the listing is sorted again once the walk is done
+        first = len(self.paths)
+        self.beginInsertRows(QModelIndex(), first, first + len(paths) - 1)
+        for row, path in enumerate(paths, first):
+            self.rows[path] = row
+        self.paths.extend(paths)
+        self.endInsertRows()
+
+    def remove_paths(self, paths):
+        rows = sorted({self.rows[path] for path in paths if path in self.rows}, reverse=True)
+        if not rows:
+            return
+        # one removal per run of adjacent rows, from the bottom so the rows above stay put
+        runs = []
+        for row in rows:
+            if runs and runs[-1][0] == row + 1:
+                runs[-1][0] = row
+            else:
+                runs.append([row, row])
+        for first, last in runs:
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.paths[first:last+1]
+            self.endRemoveRows()
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+
+    def update(self, batch):
+        """Follow a {image_path: tags, or None if the image is gone} batch of the tag scanner"""
+        self.remove_paths([path for path, tags in batch.items() if tags is None])
+        # files created after the walk went through their folder, add_paths skips those it has
+        self.add_paths([path for path, tags in batch.items() if tags is not None and self.contains(path)])
+        self.tags_changed(batch)
+
+    def tags_changed(self, paths):
+        rows = [self.rows[path] for path in paths if path in self.rows]
+        if rows:
+            self.dataChanged.emit(self.createIndex(min(rows), self.TAGS), self.createIndex(max(rows), self.TAGS), [Qt.DisplayRole])
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self.layoutAboutToBeChanged.emit()
+        # the selection and current index are persistent indexes, they move along with their paths
+        old_indexes = self.persistentIndexList()
+        old_paths = [self.paths[index.row()] for index in old_indexes]
+        if column == self.TAGS:
+            # ties in file order, so equal counts don't shuffle around on every sort
+            self.paths.sort()
+            key = self.tag_count
+        elif column == self.FOLDER:
+            key = lambda path: path.rsplit('/', 1)
+        else:
+            key = lambda path: path.rsplit('/', 1)[-1].lower()
+        self.paths.sort(key=key, reverse=order == Qt.DescendingOrder)
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+        self.changePersistentIndexList(old_indexes, [self.createIndex(self.rows[path], index.column())
+                                                     for index, path in zip(old_indexes, old_paths)])
+        self.layoutChanged.emit()
+
+class DatasetView(QTableView):
+    """Table view for a DatasetModel, lays out in constant time however many rows there are, unlike a QTreeView.
+    Has the QTreeView navigation calls the tagger uses"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setSelectionBehavior(QTableView.SelectRows)
+        self.setSelectionMode(QTableView.ExtendedSelection)
+        self.setShowGrid(False)
+        self.setWordWrap(False)
+        self.setSortingEnabled(True)
+        self.verticalHeader().hide()
+        self.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.verticalHeader().setDefaultSectionSize(self.fontMetrics().height() + 4)
+        self.horizontalHeader().setStretchLastSection(True)
+
+    def indexBelow(self, index):
+        return self.model().index(index.row() + 1, index.column()) if index.isValid() else QModelIndex()
+
+    def indexAbove(self, index):
+        return self.model().index(index.row() - 1, index.column()) if index.isValid() else QModelIndex()
+
+class ThumbnailGridModel(QAbstractListModel):
+    """Images of a multi selection, icons are only asked for, and so only decoded, for the rows a view paints"""
+
+    def __init__(self, parent, icon_cache, request_icon, icon_size):
+        super().__init__(parent)
+        self.icon_cache = icon_cache
+        self.request_icon = request_icon
+        self.paths = []
+        self.rows = {} # {image_path: row}
+        self.placeholder = QPixmap(icon_size, icon_size)
+        self.placeholder.fill(QColor(230, 230, 230))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        path = self.paths[index.row()]
+        if role == Qt.DisplayRole:
+            return os.path.basename(path)
+        if role == Qt.DecorationRole:
+            pixmap = self.icon_cache.get(path)
+            if pixmap is None:
+                self.request_icon(path)
+                return self.placeholder
+            return pixmap
+        if role in (Qt.ToolTipRole, Qt.UserRole):
+            return path
+        return None
+
+    def set_paths(self, paths):
+        self.beginResetModel()
+        self.paths = list(paths)
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+        self.endResetModel()
+
+    def thumbnail_ready(self, path):
+        row = self.rows.get(path)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+class TagHighlightDelegate(QStyledItemDelegate):
+    """Paints the background of the tags `is_highlighted` is true for, and a lighter one with the count of images
+    for the tags `partial_count` returns a number for, only the visible rows are ever asked"""
+
+    def __init__(self, is_highlighted, partial_count=None, parent=None):
+        super().__init__(parent)
+        self.is_highlighted = is_highlighted
+        self.partial_count = partial_count
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        tag = index.data()
+        if self.is_highlighted(tag):
+            option.backgroundBrush = QBrush(QColor(200, 200, 200))
+        elif self.partial_count:
+            count = self.partial_count(tag)
+            if count is not None:
+                option.backgroundBrush = QBrush(QColor(230, 230, 230))
+                option.text = f'{tag} ({count})'
+
+def completion_keys(tag):
+    """(lower cased tag, tag, 1), and (tail, tag, 0) from the start of every further word,
+    so 'long hair' is found by 'hai' too"""
+    key = tag.lower()
+    keys = [(key, tag, 1)]
+    for i in range(1, len(key)):
+        if key[i-1] in ' _-' and key[i] not in ' _-':
+            keys.append((key[i:], tag, 0))
+    return keys
+
+class TagCompleter(QCompleter):
+    """Completes tags from a sorted array of the tags of a TagListModel, kept in step with its row signals,
+    the matches of a prefix are one bisected slice, ranked by how many images carry the tag"""
+    max_results = 20
+
+    def __init__(self, tag_model, frequency, parent=None):
+        super().__init__(parent)
+        self.tag_model = tag_model
+        self.frequency = frequency
+        self.keys = [] # sorted [(completion key, tag, whether the key is the whole tag)]
+        self.results = QStringListModel(self)
+        self.setModel(self.results)
+        # the results are filtered and ordered already
+        self.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.setMaxVisibleItems(self.max_results)
+        tag_model.rowsInserted.connect(lambda parent, first, last: self.add_rows(first, last))
+        tag_model.rowsAboutToBeRemoved.connect(lambda parent, first, last: self.remove_rows(first, last))
+        tag_model.dataChanged.connect(lambda first, last: self.add_rows(first.row(), last.row()))
+        tag_model.modelReset.connect(self.rebuild)
+        self.rebuild()
+
+    def rebuild(self):
+        merged = self.tag_model.merged
+        if merged is not None:
+            # only the keys of the tags add_many brought in need sorting
+            self.keys = list(heapq.merge(self.keys, sorted(key for tag in merged for key in completion_keys(tag))))
+        else:
+            self.keys = sorted(key for tag in self.tag_model.tags for key in completion_keys(tag))
+
+    def add(self, tag):
+        if not tag:
+            return
+        for key in completion_keys(tag):
+            i = bisect.bisect_left(self.keys, key)
+            if i == len(self.keys) or self.keys[i] != key:
+                self.keys.insert(i, key)
+
+    def remove(self, tag):
+        if tag in self.tag_model:
+            return # the model still has another row of it, for the moment of a drag
+        for key in completion_keys(tag):
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+
+    def add_rows(self, first, last):
+        for tag in self.tag_model.tags[first:last+1]:
+            self.add(tag)
+
+    def remove_rows(self, first, last):
+        tags = self.tag_model.tags[first:last+1]
+        # the rows are still there while this runs, look again once they are gone
+        QTimer.singleShot(0, lambda: [self.remove(tag) for tag in tags])
+
+    def matches(self, prefix):
+        """Up to max_results tags with a word starting with prefix, tags starting with it first, then the most used"""
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        first = bisect.bisect_left(self.keys, (prefix,))
+        last = bisect.bisect_left(self.keys, (prefix + '\U0010ffff',))
+        tags = {}
+        for _, tag, whole in self.keys[first:last]:
+            if tag in self.tag_model:
+                tags[tag] = tags.get(tag, 0) | whole
+        frequency = self.frequency
+        return heapq.nlargest(self.max_results, tags, key=lambda tag: (tags[tag], frequency(tag)))
+
+    def show_matches(self, text):
+        """Fill the popup with the matches of text, call on every edit of the widget"""
+        self.results.setStringList(self.matches(text))
+        if self.results.rowCount():
+            self.complete()
+        else:
+            self.popup().hide()
+
+ImageHeader = namedtuple('ImageHeader', 'reader size can_scale')
+
+def read_image_header(path):
+    """Open an image and read only its header. size is None if the header doesn't tell it, can_scale is True
+    if the decoder itself produces smaller images (jpeg picks a smaller DCT, png scales row by row)"""
+    reader = QImageReader(path)
+    size = reader.size()
+    if not size.isValid() or size.isEmpty():
+        size = None
+    return ImageHeader(reader, size, reader.supportsOption(QImageIOHandler.ScaledSize))
+
+class DecodeBudget:
+    """Bounds the memory of the full size decodes running at the same time in this process,
+    an image larger than the whole budget is decoded alone"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        nbytes = min(nbytes, self.max_bytes)
+        with self.condition:
+            self.condition.wait_for(lambda: self.used == 0 or self.used + nbytes <= self.max_bytes)
+            self.used += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used -= nbytes
+            self.condition.notify_all()
+
+decode_budget = DecodeBudget(int(os.environ.get('LITTLETAGGER_DECODE_MB', 1024)) * 1024 * 1024)
+
+def decode_image(header, scaled_size=None, clip_rect=None):
+    """Decode the image of header at scaled_size, cut down to clip_rect in scaled coordinates. Formats that can
+    scale do it while decoding, the rest are decoded at full size and scaled after, within decode_budget"""
+    reader = header.reader
+    if scaled_size is not None and scaled_size != header.size:
+        reader.setScaledSize(scaled_size)
+    else:
+        scaled_size = None
+    if clip_rect is not None:
+        # the reader cuts it out after decoding if the format can't
+        reader.setScaledClipRect(clip_rect)
+    if header.size is None or (scaled_size is not None and header.can_scale):
+        with perf.span('decode.scaled'):
+            return reader.read()
+    nbytes = decode_budget.acquire(header.size.width() * header.size.height() * 4)
+    try:
+        with perf.span('decode.full'):
+            return reader.read()
+    finally:
+        decode_budget.release(nbytes)
+
+def load_scaled_image(path, width):
+    """Decode an image straight to the given width, without decoding it at full size first"""
+    header = read_image_header(path)
+    scaled_size = None
+    if header.size is not None and header.size.width() > width:
+        scaled_size = QSize(width, max(1, round(header.size.height() * width / header.size.width())))
+    image = decode_image(header, scaled_size)
+    if not image.isNull() and image.width() != width:
+        image = image.scaledToWidth(width, Qt.SmoothTransformation)
+    return image
+
+class PixmapCache:
+    """LRU cache of pixmaps bounded by the memory their pixel data takes"""
+
+    def __init__(self, max_bytes=512*1024*1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict() # {key: (pixmap, nbytes)}
+
+    @staticmethod
+    def pixmap_bytes(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        pixmap = self.get(key)
+        if pixmap is None:
+            raise KeyError(key)
+        return pixmap
+
+    def __setitem__(self, key, pixmap):
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[1]
+        nbytes = self.pixmap_bytes(pixmap)
+        self.entries[key] = (pixmap, nbytes)
+        self.total_bytes += nbytes
+        self.evict()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def peek(self, key):
+        """Look an entry up without counting it as a use"""
+        entry = self.entries.get(key)
+        return None if entry is None else entry[0]
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def evict(self):
+        # always keep the most recent entry, even if it alone exceeds the budget
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, nbytes) = self.entries.popitem(last=False)
+            self.total_bytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+def default_cache_dir():
+    return os.environ.get('LITTLETAGGER_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'littletagger')
+
+def session_settings():
+    return QSettings(os.path.join(default_cache_dir(), 'session.ini'), QSettings.IniFormat)
+
+class DiskThumbnailCache:
+    """Persistent thumbnail store, encoded thumbnails are appended to a few large pack files
+    and located through an sqlite index keyed by (path, width) and validated by mtime and size"""
+    pack_bytes = 64*1024*1024
+
+    def __init__(self, directory, max_bytes=2*1024*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS thumbs (path TEXT, width INTEGER, mtime INTEGER, size INTEGER, '
+                        'pack INTEGER, offset INTEGER, length INTEGER, PRIMARY KEY (path, width))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS thumbs_pack ON thumbs (pack)')
+        self.db.commit()
+        packs = self.list_packs()
+        self.current_pack = packs[-1] if packs else 1
+        self.writer = open(self.pack_path(self.current_pack), 'ab')
+        self.dirty = 0
+
+    def pack_path(self, pack):
+        return os.path.join(self.directory, f'pack-{pack:05d}.bin')
+
+    def list_packs(self):
+        packs = []
+        for name in os.listdir(self.directory):
+            if name.startswith('pack-') and name.endswith('.bin'):
+                packs.append(int(name[5:-4]))
+        return sorted(packs)
+
+    def get(self, path, width, mtime, size):
+        """Return the encoded thumbnail bytes, or None if missing or stale"""
+        with self.lock:
+            row = self.db.execute('SELECT mtime, size, pack, offset, length FROM thumbs WHERE path=? AND width=?',
+                                  (path, width)).fetchone()
+            if row is None:
+                return None
+            if (row[0], row[1]) != (mtime, size):
+                # the source changed since the thumbnail was made, it'll be rebuilt
+                self.db.execute('DELETE FROM thumbs WHERE path=? AND width=?', (path, width))
+                self.dirty += 1
+                return None
+            if row[2] == self.current_pack:
+                self.writer.flush()
+            try:
+                with open(self.pack_path(row[2]), 'rb') as f:
+                    f.seek(row[3])
+                    data = f.read(row[4])
+            except OSError:
+                data = b''
+            if len(data) != row[4]:
+                self.db.execute('DELETE FROM thumbs WHERE path=? AND width=?', (path, width))
+                self.dirty += 1
+                return None
+            return data
+
+    def put(self, path, width, mtime, size, data):
+        with self.lock:
+            if self.writer.tell() + len(data) > self.pack_bytes and self.writer.tell() > 0:
+                self.writer.close()
+                self.current_pack += 1
+                self.writer = open(self.pack_path(self.current_pack), 'ab')
+            offset = self.writer.tell()
+            self.writer.write(data)
+            self.db.execute('INSERT OR REPLACE INTO thumbs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (path, width, mtime, size, self.current_pack, offset, len(data)))
+            self.dirty += 1
+            if self.dirty >= 64:
+                self.commit()
+
+    def commit(self):
+        # pack data must hit the file before the index points at it
+        self.writer.flush()
+        self.db.commit()
+        self.dirty = 0
+
+    def flush(self):
+        with self.lock:
+            self.commit()
+
+    def gc(self):
+        """Drop the oldest packs until the cache fits into max_bytes"""
+        with self.lock:
+            self.commit()
+            packs = self.list_packs()
+            total = sum(os.path.getsize(self.pack_path(pack)) for pack in packs)
+            for pack in packs:
+                if total <= self.max_bytes or pack == self.current_pack:
+                    break
+                total -= os.path.getsize(self.pack_path(pack))
+                self.db.execute('DELETE FROM thumbs WHERE pack=?', (pack,))
+                os.remove(self.pack_path(pack))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.writer.close()
+            self.db.close()
+
+def encode_thumbnail(image):
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    image.save(buffer, 'PNG' if image.hasAlphaChannel() else 'JPG', -1 if image.hasAlphaChannel() else 90)
+    buffer.close()
+    return bytes(data)
+
+class ThumbnailJob(QRunnable):
+    def __init__(self, loader, path, width, generation):
+        super().__init__()
+        self.loader = loader
+        self.path = path
+        self.width = width
+        self.generation = generation
+
+    def run(self):
+        # the selection may have changed while this job was waiting in the queue
+        if not self.loader.begin(self.path, self.width, self.generation):
+            return
+        try:
+            image = self.loader.load(self.path, self.width)
+        finally:
+            self.loader.end(self.path, self.width)
+        # once decoded, the result is worth caching even if nobody waits for it any more
+        self.loader.thumbnail_loaded.emit(self.path, self.width, image)
+
+class ThumbnailLoader(QObject):
+    """Decodes thumbnails on a thread pool and reports them back to the GUI thread as they finish"""
+    thumbnail_loaded = QtCore.pyqtSignal(str, int, QImage)
+
+    def __init__(self, parent=None, disk_cache=None):
+        super().__init__(parent)
+        self.disk_cache = disk_cache
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max(2, QThread.idealThreadCount() - 1))
+        self.generation = 0
+        self.pending = set() # {(path, width)} queued since the last cancel
+        self.running = set() # {(path, width)} being decoded right now, touched from the pool threads
+        self.lock = threading.Lock()
+        self.thumbnail_loaded.connect(self.on_thumbnail_loaded)
+
+    def request(self, path, width, priority=1):
+        """Queue a decode, prefetches use priority 0 so everything asked for by the view goes first"""
+        if (path, width) in self.pending:
+            return
+        with self.lock:
+            if (path, width) in self.running:
+                return
+        self.pending.add((path, width))
+        self.pool.start(ThumbnailJob(self, path, width, self.generation), priority)
+
+    def begin(self, path, width, generation):
+        with self.lock:
+            if generation != self.generation or (path, width) in self.running:
+                return False
+            self.running.add((path, width))
+            return True
+
+    def end(self, path, width):
+        with self.lock:
+            self.running.discard((path, width))
+
+    def load_cached(self, path, width):
+        """Return the thumbnail from the disk cache, or None if it has to be decoded"""
+        if self.disk_cache is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with perf.span('decode.disk_cache'):
+            data = self.disk_cache.get(path, width, st.st_mtime_ns, st.st_size)
+            image = None if data is None else QImage.fromData(data)
+        return None if image is None or image.isNull() else image
+
+    def load(self, path, width):
+        image = self.load_cached(path, width)
+        if image is not None:
+            return image
+        with perf.span('decode'):
+            image = load_scaled_image(path, width)
+        if self.disk_cache is not None and not image.isNull():
+            try:
+                st = os.stat(path)
+                self.disk_cache.put(path, width, st.st_mtime_ns, st.st_size, encode_thumbnail(image))
+            except OSError:
+                pass
+        return image
+
+    def cancel(self):
+        """Drop all queued jobs, running jobs finish and still report their results"""
+        with self.lock:
+            self.generation += 1
+        self.pool.clear()
+        self.pending.clear()
+
+    def on_thumbnail_loaded(self, path, width, image):
+        self.pending.discard((path, width))
+
+def parse_sizes(text):
+    """'512x512, 768x1024' -> [(512, 512), (768, 1024)], raises ValueError"""
+    sizes = []
+    for item in text.replace(';', ',').split(','):
+        item = item.strip().lower()
+        if not item:
+            continue
+        width, _, height = item.partition('x')
+        try:
+            width, height = int(width), int(height or width)
+        except ValueError:
+            width = height = 0
+        if width <= 0 or height <= 0:
+            raise ValueError(f'invalid size {item!r}')
+        sizes.append((width, height))
+    if not sizes:
+        raise ValueError('no size given')
+    return sizes
+
+def size_folder(width, height):
+    return f'{width}x{height}'
+
+def center_crop(image, crop_width, crop_height):
+    """Scale image to cover crop_width x crop_height, then cut out the center"""
+    if image.size() == QSize(crop_width, crop_height):
+        return image
+    if image.width()/image.height() > crop_width/crop_height:
+        image = image.scaledToHeight(crop_height, Qt.SmoothTransformation)
+    else:
+        image = image.scaledToWidth(crop_width, Qt.SmoothTransformation)
+    return image.copy((image.width() - crop_width) // 2, (image.height() - crop_height) // 2, crop_width, crop_height)
+
+def nearest_aspect(size, outputs):
+    """The output of [(save_path, width, height)] whose aspect ratio is closest to that of size"""
+    aspect = math.log(size.width() / size.height())
+    return min(outputs, key=lambda output: abs(math.log(output[1] / output[2]) - aspect))
+
+def decode_for_sizes(header, sizes):
+    """Decode the image of header to the smallest size a center crop of every (width, height) of sizes can be cut from,
+    for a single size only that crop is decoded"""
+    size = header.size
+    scaled = clip = None
+    if size is not None:
+        scale = max(max(width / size.width(), height / size.height()) for width, height in sizes)
+        if scale <= 1:
+            scaled = QSize(max(1, round(size.width() * scale)), max(1, round(size.height() * scale)))
+            if len(sizes) == 1:
+                crop_width, crop_height = sizes[0]
+                clip = QRect((scaled.width() - crop_width) // 2, (scaled.height() - crop_height) // 2, crop_width, crop_height)
+    return decode_image(header, scaled, clip)
+
+def crop_resize_outputs(path, outputs, override=True, bucket=False, copy_sidecar=False):
+    """Decode an image once and save a resized center crop for every (save_path, width, height) of outputs,
+    or with bucket only for the one closest to the image's aspect ratio. The largest output decides the decode size.
+    Copies the sidecar of the image next to every output if asked, returns (path, ok, message)"""
+    header = read_image_header(path)
+    size = header.size
+    if bucket and size is not None:
+        outputs = [nearest_aspect(size, outputs)]
+    if not override:
+        outputs = [output for output in outputs if not os.path.exists(output[0])]
+        if not outputs:
+            return path, True, 'exists'
+    image = decode_for_sizes(header, [(width, height) for _, width, height in outputs])
+    if image.isNull():
+        return path, False, header.reader.errorString()
+    if bucket and size is None:
+        outputs = [nearest_aspect(image.size(), outputs)]
+
+    tag_path = sidecar_path(path)
+    has_sidecar = copy_sidecar and os.path.isfile(tag_path)
+    for save_path, crop_width, crop_height in outputs:
+        if not center_crop(image, crop_width, crop_height).save(save_path):
+            return path, False, f'failed to write {save_path}'
+        if has_sidecar:
+            try:
+                shutil.copyfile(tag_path, sidecar_path(save_path))
+            except OSError as e:
+                return path, False, f'failed to copy {tag_path}: {e}'
+    return path, True, 'saved'
+
+def crop_manifest_path(save_dir):
+    return os.path.join(save_dir, '.littletagger-crop.jsonl')
+
+class CropManifest:
+    """Append only record of the crop jobs run into a save directory, one json line per image with its mtime, size
+    and the job's parameters. A rerun skips the images whose last entry still matches, before decoding anything"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {} # {image_path: entry}
+        line = '\n'
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line of a run that was killed
+                        continue
+                    self.entries[entry['source']] = entry
+        except FileNotFoundError:
+            pass
+        self.file = open(path, 'a', encoding='utf-8')
+        if not line.endswith('\n'):
+            self.file.write('\n')
+
+    @staticmethod
+    def stamp(path, outputs, bucket=False, copy_sidecar=False):
+        """What the entry of a job has to match for it to be skipped, None if the image is gone"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        tags_mtime = None
+        if copy_sidecar:
+            try:
+                tags_mtime = os.stat(sidecar_path(path)).st_mtime_ns
+            except OSError:
+                pass
+        return [st.st_mtime_ns, st.st_size, tags_mtime, bucket, [list(output) for output in outputs]]
+
+    def is_done(self, path, stamp):
+        entry = self.entries.get(path)
+        if stamp is None or entry is None or not entry['ok'] or entry['stamp'] != stamp:
+            return False
+        # with buckets only the output closest in aspect ratio was written
+        exists = any if stamp[3] else all
+        return exists(os.path.exists(save_path) for save_path, _, _ in stamp[4])
+
+    def record(self, path, stamp, ok, message):
+        entry = self.entries[path] = {'source': path, 'stamp': stamp, 'ok': ok, 'message': message}
+        self.file.write(json.dumps(entry) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def imap_unordered_bounded(executor, func, iterable, max_pending, should_stop=lambda: False):
+    """Yield func(*args) for every args of iterable as they complete, pulling new items from
+    iterable only when a slot frees up, so a huge input stream is never listed in memory"""
+    items = iter(iterable)
+    running = set()
+    while not should_stop():
+        while len(running) < max_pending:
+            args = next(items, None)
+            if args is None:
+                break
+            running.add(executor.submit(func, *args))
+        if not running:
+            break
+        finished, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            yield future
+
+def make_executor(workers, use_processes=False):
+    if use_processes:
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    return ThreadPoolExecutor(workers)
+
+class CropResizeEngine(QObject):
+    """Runs crop_resize_outputs over a list of (path, [(save_path, width, height)]) on a thread or process pool,
+    skipping the images a CropManifest has as done. Results are reported in batches, report_interval apart"""
+    files_done = QtCore.pyqtSignal(list) # [(path, ok, message)]
+    progress = QtCore.pyqtSignal(int, int, float) # done, total, files per second
+    all_done = QtCore.pyqtSignal(bool) # canceled
+    report_interval = 0.1
+
+    def __init__(self, jobs, override=True, workers=None, use_processes=False, bucket=False, copy_sidecars=False, manifest=None):
+        super().__init__()
+        self.jobs = jobs
+        self.override = override
+        self.bucket = bucket
+        self.copy_sidecars = copy_sidecars
+        self.workers = workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.manifest = manifest
+        self.canceled = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        """Stop handing out work, files being processed right now still finish in the background"""
+        self.canceled = True
+
+    def run(self):
+        executor = make_executor(self.workers, self.use_processes)
+        manifest = self.manifest
+        stamps = {} # {path: stamp} of the jobs handed out
+        results = []
+        num_done = 0
+        started = last_report = time.perf_counter()
+
+        def report(force=False):
+            nonlocal results, last_report
+            now = time.perf_counter()
+            if results and (force or now - last_report >= self.report_interval):
+                last_report = now
+                self.files_done.emit(results)
+                results = []
+                self.progress.emit(num_done, len(self.jobs), num_done / max(now - started, 1e-6))
+                if manifest is not None:
+                    manifest.flush()
+
+        def jobs():
+            nonlocal num_done
+            for path, outputs in self.jobs:
+                if manifest is not None:
+                    stamp = manifest.stamp(path, outputs, self.bucket, self.copy_sidecars)
+                    if manifest.is_done(path, stamp):
+                        num_done += 1
+                        results.append((path, True, 'unchanged'))
+                        report()
+                        continue
+                    stamps[path] = stamp
+                    # outputs an earlier run saved from this image are redone even without override
+                    yield path, outputs, self.override or path in manifest.entries, self.bucket, self.copy_sidecars
+                else:
+                    yield path, outputs, self.override, self.bucket, self.copy_sidecars
+
+        try:
+            # keep the pool busy, but don't queue more than can be dropped quickly on cancel
+            for future in imap_unordered_bounded(executor, crop_resize_outputs, jobs(), self.workers * 2, lambda: self.canceled):
+                try:
+                    path, ok, message = future.result()
+                except Exception as e:
+                    path, ok, message = '', False, str(e)
+                num_done += 1
+                results.append((path, ok, message))
+                # outputs that were there before aren't known to be from these settings
+                if path in stamps and message != 'exists':
+                    manifest.record(path, stamps.pop(path), ok, message)
+                report()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            report(force=True)
+            if manifest is not None:
+                manifest.close()
+            self.all_done.emit(self.canceled)
+
 class CropResizeAndSaveToDialog(QDialog):
-    image_cropped = QtCore.pyqtSignal(str)
-    image_all_croped = QtCore.pyqtSignal()
 
     def __init__(self, parent=None, files=[]):
         super().__init__(parent)
@@ -48,14 +2174,17 @@ class CropResizeAndSaveToDialog(QDialog):
             listitem = QListWidgetItem(path)
             self.item_list.addItem(listitem)
             self.item_map[path] = listitem
-        size_label = QLabel('Width x Height:')
-        self.crop_width_edit = QLineEdit()
-        self.crop_width_edit.setText('512')
-        self.crop_width_edit.setFixedWidth(50)
-        x_label = QLabel('x')
-        self.crop_height_edit = QLineEdit()
-        self.crop_height_edit.setText('512')
-        self.crop_height_edit.setFixedWidth(50)
+        size_label = QLabel('Sizes:')
+        self.sizes_edit = QLineEdit()
+        self.sizes_edit.setText('512x512')
+        self.sizes_edit.setToolTip('Width x height, separated by commas. With more than one size every size goes to its own subfolder')
+        self.bucket_check = QCheckBox('Aspect buckets')
+        self.bucket_check.setToolTip('Save each image only in the size closest to its aspect ratio, instead of in every size')
+        self.copy_sidecars = QCheckBox('Copy tag files')
+        self.copy_sidecars.setChecked(True)
+        self.resume = QCheckBox('Skip unchanged')
+        self.resume.setChecked(True)
+        self.resume.setToolTip('Skip images an earlier run already saved here with the same settings, unless they changed since')
         self.save_dir_label = QLabel('Save To:')
         self.save_dir_edit = QLineEdit()
         self.save_dir_edit.setText(os.path.join(os.path.commonprefix(self.files), 'prepared'))
@@ -64,24 +2193,28 @@ class CropResizeAndSaveToDialog(QDialog):
         self.do_override = QCheckBox('Override existing files')
         self.prefix = QLineEdit()
         self.prefix.setFixedWidth(100)
+        self.num_workers = QSpinBox()
+        self.num_workers.setRange(1, 256)
+        self.num_workers.setValue(os.cpu_count() or 1)
+        self.use_processes = QComboBox()
+        self.use_processes.addItems(['Threads', 'Processes'])
         self.progress = QProgressBar()
+        self.status_label = QLabel()
         self.save_button = QPushButton('Save')
         self.save_button.clicked.connect(self.save_images)
         self.cancel_button = QPushButton('Cancel')
         self.cancel_button.clicked.connect(self.do_cancel)
-        self.work_thread = None
-        self.canceled = False
-        self.image_cropped.connect(self.on_image_croped)
-        self.image_all_croped.connect(self.on_image_all_croped)
-        self.num_job_done = 0
+        self.engine = None
         
         # Create layout for the dialog
         layout = QVBoxLayout()
         layout.addWidget(self.item_list)
         layout.addWidget(self.progress)
-        layout.addLayout(hline(size_label, self.crop_width_edit, x_label, self.crop_height_edit, QSpacerItem(0,0,QSizePolicy.Expanding), stretch=(0, 0, 0, 0, 1)))
+        layout.addWidget(self.status_label)
+        layout.addLayout(hline(size_label, self.sizes_edit, self.bucket_check, stretch=(0, 1, 0)))
         layout.addLayout(hline(self.save_dir_label, self.save_dir_edit, self.save_dir_button, stretch=(0, 1, 0)))
-        layout.addLayout(hline(self.do_override, QLabel('Name prefix:'), self.prefix, stretch=(0, 0, 1)))
+        layout.addLayout(hline(self.do_override, self.copy_sidecars, self.resume, QLabel('Name prefix:'), self.prefix, stretch=(0, 0, 0, 0, 1)))
+        layout.addLayout(hline(QLabel('Workers:'), self.num_workers, self.use_processes, QSpacerItem(0,0,QSizePolicy.Expanding), stretch=(0, 0, 0, 1)))
         layout.addLayout(hline(self.save_button, self.cancel_button))
         self.setLayout(layout)
         
@@ -92,28 +2225,38 @@ class CropResizeAndSaveToDialog(QDialog):
             self.save_dir_edit.setText(save_dir)
 
     def do_cancel(self):
-        self.canceled = True
-        if self.work_thread:
-            self.work_thread.join()
+        # don't wait for the workers here, the ones still running finish on their own
+        if self.engine:
+            self.engine.cancel()
         self.reject()
 
-    def on_image_croped(self, path):
-        self.num_job_done += 1
-        self.progress.setValue(self.num_job_done/len(self.files)*100)
-        self.item_map[path].setBackground(QColor(104, 159, 56))
+    def on_image_croped(self, results):
+        for path, ok, message in results:
+            if path in self.item_map:
+                self.item_map[path].setBackground(QColor(104, 159, 56) if ok else QColor(211, 47, 47))
+                self.item_map[path].setToolTip(message)
+
+    def on_progress(self, done, total, throughput):
+        self.progress.setValue(int(done/max(total, 1)*100))
+        self.status_label.setText(f'{done} / {total} files, {throughput:.1f} files/s')
+
+    def on_image_all_croped(self, canceled):
+        if not canceled:
+            self.accept()
 
-    def on_image_all_croped(self):
-        self.accept()
-        
     def save_images(self):
         """Crop and save the selected images to the chosen directory"""
+        # Get the crop sizes from the edit box
+        try:
+            sizes = list(dict.fromkeys(parse_sizes(self.sizes_edit.text())))
+        except ValueError as e:
+            QMessageBox.warning(self, 'Invalid Sizes', f'{e}, use e.g. 512x512, 768x768')
+            return
+        bucket = self.bucket_check.isChecked()
+
         # Don't press twice
         self.save_button.setEnabled(False)
 
-        # Get the crop width and height from the edit boxes
-        crop_width = int(self.crop_width_edit.text())
-        crop_height = int(self.crop_height_edit.text())
-
         override = self.do_override.isChecked()
         prefix = self.prefix.text()
         
@@ -122,42 +2265,424 @@ class CropResizeAndSaveToDialog(QDialog):
         if not save_dir:
             QMessageBox.warning(self, 'No Save Directory', 'Please choose a directory to save the cropped images.')
             return
-        if not os.path.exists(save_dir):
+        # a single size goes straight into the save directory, several into a subfolder each
+        size_dirs = [(save_dir if len(sizes) == 1 else os.path.join(save_dir, size_folder(*size)), *size) for size in sizes]
+        try:
+            for size_dir, _, _ in size_dirs:
+                os.makedirs(size_dir, exist_ok=True)
+        except OSError:
+            QMessageBox.warning(self, 'Invalid Save Directory', 'The chosen directory is invalid.')
+            self.save_button.setEnabled(True)
+            return
+
+        jobs = [(path, [(os.path.join(size_dir, prefix+os.path.basename(path)), width, height) for size_dir, width, height in size_dirs])
+                for path in self.files]
+        manifest = None
+        if self.resume.isChecked():
             try:
-                os.makedirs(save_dir)
-            except:
-                QMessageBox.warning(self, 'Invalid Save Directory', 'The chosen directory is invalid.')
+                manifest = CropManifest(crop_manifest_path(save_dir))
+            except OSError as e:
+                QMessageBox.warning(self, 'Error', f'Failed to open the manifest of {save_dir}: {e}')
+                self.save_button.setEnabled(True)
                 return
+        self.engine = CropResizeEngine(jobs, override, workers=self.num_workers.value(), use_processes=self.use_processes.currentIndex() == 1,
+                                       bucket=bucket, copy_sidecars=self.copy_sidecars.isChecked(), manifest=manifest)
+        self.engine.files_done.connect(self.on_image_croped)
+        self.engine.progress.connect(self.on_progress)
+        self.engine.all_done.connect(self.on_image_all_croped)
+        self.engine.start()
+
+def shard_name(prefix, number):
+    return f'{prefix}-{number:06d}.tar'
+
+def add_tar_member(tar, name, size, fileobj, mtime):
+    """Append a member to a ustar tar, returns [name, offset of its data in the tar, size]"""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    # a ustar header of a short name is one block
+    offset = tar.offset + tarfile.BLOCKSIZE
+    tar.addfile(info, fileobj)
+    return [name, offset, size]
+
+def write_shard(shard_path, samples, crop_size=None, should_stop=lambda: False):
+    """Write [(key, image_path, tags or None to read the sidecar)] into one tar, as key.jpg / key.png and key.txt pairs.
+    Images are copied from the source file as they are, or with crop_size decoded, center cropped and encoded in memory.
+    The tar is written front to back through a buffer and renamed into place when complete.
+    Returns ({'shard', 'members': [[name, data offset, size]], 'sources'}, [(image_path, error)]), or None if stopped"""
+    tmp_path = shard_path + '.tmp'
+    members = []
+    sources = []
+    failed = []
+    try:
+        with open(tmp_path, 'wb', buffering=1024*1024) as f, tarfile.open(fileobj=f, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+            for key, path, tags in samples:
+                if should_stop():
+                    raise InterruptedError
+                extension = os.path.splitext(path)[1].lower().lstrip('.')
+                try:
+                    if tags is None:
+                        try:
+                            tags = read_sidecar(sidecar_path(path))
+                        except FileNotFoundError:
+                            tags = []
+                    if crop_size is None:
+                        with open(path, 'rb') as image_file:
+                            st = os.fstat(image_file.fileno())
+                            image_member = add_tar_member(tar, f'{key}.{extension}', st.st_size, image_file, int(st.st_mtime))
+                    else:
+                        header = read_image_header(path)
+                        image = decode_for_sizes(header, [crop_size])
+                        if image.isNull():
+                            raise OSError(header.reader.errorString())
+                        data = QByteArray()
+                        buffer = QBuffer(data)
+                        buffer.open(QIODevice.WriteOnly)
+                        center_crop(image, *crop_size).save(buffer, 'PNG' if extension == 'png' else 'JPG')
+                        buffer.close()
+                        data = bytes(data)
+                        image_member = add_tar_member(tar, f'{key}.{extension}', len(data), io.BytesIO(data), int(time.time()))
+                except OSError as e:
+                    # a member that was started can't be taken back, anything else is left out
+                    if tar.offset != f.tell():
+                        raise
+                    failed.append((path, str(e) or type(e).__name__))
+                    continue
+                caption = ', '.join(tags).encode('utf-8', 'surrogateescape')
+                members.append(image_member)
+                members.append(add_tar_member(tar, f'{key}.txt', len(caption), io.BytesIO(caption), int(time.time())))
+                sources.append(path)
+        os.replace(tmp_path, shard_path)
+    except BaseException as e:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        if isinstance(e, InterruptedError):
+            return None
+        raise
+    return {'shard': os.path.basename(shard_path), 'members': members, 'sources': sources}, failed
+
+def export_shards(samples, out_dir, shard_samples=1000, crop_size=None, workers=None, prefix='data',
+                  progress=None, should_stop=lambda: False):
+    """Stream (image_path, tags or None) samples into tar shards of shard_samples (image, caption) pairs each.
+    samples is consumed lazily, the shards are written in parallel and each one by a single worker.
+    index.jsonl gets one line per shard with the data offset of every member, for random access.
+    Returns ([shard index entries], [(image_path, error)])"""
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    total = len(samples) if hasattr(samples, '__len__') else 0
+    samples = iter(samples)
+
+    def shards():
+        number = 0
+        while True:
+            chunk = list(islice(samples, shard_samples))
+            if not chunk:
+                return
+            start = number * shard_samples
+            yield (os.path.join(out_dir, shard_name(prefix, number)),
+                   [(f'{start + i:09d}', path, tags) for i, (path, tags) in enumerate(chunk)], crop_size, should_stop)
+            number += 1
+
+    entries = []
+    failed = []
+    num_done = 0
+    with ThreadPoolExecutor(workers) as executor:
+        for future in imap_unordered_bounded(executor, write_shard, shards(), workers * 2, should_stop):
+            result = future.result()
+            if result is None:
+                continue
+            entry, shard_failed = result
+            entries.append(entry)
+            failed.extend(shard_failed)
+            num_done += len(entry['sources']) + len(shard_failed)
+            if progress:
+                progress(num_done, total)
+    entries.sort(key=lambda entry: entry['shard'])
+    index_path = os.path.join(out_dir, 'index.jsonl')
+    with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    os.replace(index_path + '.tmp', index_path)
+    return entries, failed
+
+class ExportShardsDialog(QDialog):
+    """Asks where and how to export tar shards, the export itself runs as a background task of the main window"""
+
+    def __init__(self, parent, directory, num_images):
+        super().__init__(parent)
+        self.setWindowTitle('Export Tar Shards')
+        self.out_dir_edit = QLineEdit(os.path.join(directory, 'shards'))
+        browse_button = QPushButton('...')
+        browse_button.clicked.connect(self.browse_out_dir)
+        self.shard_samples = QSpinBox()
+        self.shard_samples.setRange(1, 1000000)
+        self.shard_samples.setValue(1000)
+        self.crop_check = QCheckBox('Resize / crop to')
+        self.crop_size_edit = QLineEdit('512x512')
+        self.crop_size_edit.setEnabled(False)
+        self.crop_check.toggled.connect(self.crop_size_edit.setEnabled)
+        self.num_workers = QSpinBox()
+        self.num_workers.setRange(1, 256)
+        self.num_workers.setValue(os.cpu_count() or 1)
+        export_button = QPushButton('Export')
+        export_button.clicked.connect(self.check_and_accept)
+        cancel_button = QPushButton('Cancel')
+        cancel_button.clicked.connect(self.reject)
 
-        def thread_function():
-            # Crop and save each selected image
-            for path in self.files:
-                if self.canceled:
-                    break
-                image = QImage(path)
-                # resize to best matching size, crop the center area if aspect ratio is different
-                if image.width()/image.height() > crop_width/crop_height:
-                    image = image.scaledToHeight(crop_height, Qt.SmoothTransformation)
-                    crop_x = (image.width() - crop_width) // 2
-                    crop_y = 0
-                    cropped_image = image.copy(crop_x, crop_y, crop_width, crop_height)
-                else:
-                    image = image.scaledToWidth(crop_width, Qt.SmoothTransformation)
-                    crop_x = 0
-                    crop_y = (image.height() - crop_height) // 2
-                    cropped_image = image.copy(crop_x, crop_y, crop_width, crop_height)
-                
-                save_path = os.path.join(save_dir, prefix+os.path.basename(path))
-                if override or not os.path.exists(save_path):
-                    cropped_image.save(save_path)
-                self.image_cropped.emit(path)
-            self.image_all_croped.emit()
-
-        self.work_thread = threading.Thread(target=thread_function)
-        self.work_thread.start()
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel(f'{num_images} images, with their tags as captions'))
+        layout.addLayout(hline(QLabel('Save To:'), self.out_dir_edit, browse_button, stretch=(0, 1, 0)))
+        layout.addLayout(hline(QLabel('Images per shard:'), self.shard_samples, QSpacerItem(0,0,QSizePolicy.Expanding), stretch=(0, 0, 1)))
+        layout.addLayout(hline(self.crop_check, self.crop_size_edit, stretch=(0, 1)))
+        layout.addLayout(hline(QLabel('Workers:'), self.num_workers, QSpacerItem(0,0,QSizePolicy.Expanding), stretch=(0, 0, 1)))
+        layout.addLayout(hline(export_button, cancel_button))
+        self.setLayout(layout)
+
+    def browse_out_dir(self):
+        out_dir = QFileDialog.getExistingDirectory(self, 'Choose Directory', self.out_dir_edit.text())
+        if out_dir:
+            self.out_dir_edit.setText(out_dir)
+
+    def crop_size(self):
+        """(width, height) to crop to, or None, raises ValueError"""
+        return parse_sizes(self.crop_size_edit.text())[0] if self.crop_check.isChecked() else None
+
+    def check_and_accept(self):
+        try:
+            self.crop_size()
+        except ValueError as e:
+            QMessageBox.warning(self, 'Invalid Size', f'{e}, use e.g. 512x512')
+            return
+        if not self.out_dir_edit.text():
+            QMessageBox.warning(self, 'No Save Directory', 'Please choose a directory to save the shards.')
+            return
+        self.accept()
+
+def dhash(path, hash_size=8):
+    """64 bit difference hash, whether the brightness rises between neighbouring pixels of a 9x8 thumbnail,
+    decoded small straight away, returns None if the image can't be read"""
+    header = read_image_header(path)
+    size = header.size
+    # the hash ignores the aspect ratio as well
+    image = decode_image(header, QSize(64, 64) if size is not None and size.width() > 64 and size.height() > 64 else None)
+    if image.isNull():
+        return None
+    image = image.scaled(hash_size + 1, hash_size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation).convertToFormat(QImage.Format_Grayscale8)
+    stride = image.bytesPerLine()
+    bits = image.constBits()
+    bits.setsize(stride * hash_size)
+    pixels = bytes(bits)
+    value = 0
+    for y in range(hash_size):
+        row = pixels[y*stride:y*stride + hash_size + 1]
+        for x in range(hash_size):
+            value = value << 1 | (row[x] < row[x+1])
+    return value
+
+class HashCache:
+    """Perceptual hashes of images in sqlite, keyed by path and validated by mtime and size"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, hash INTEGER)')
+        self.db.commit()
+
+    def load(self, directory):
+        """{image_path: (mtime, size, hash)} of everything cached under directory"""
+        root = directory.rstrip('/\\') + '/'
+        with self.lock:
+            rows = self.db.execute('SELECT path, mtime, size, hash FROM hashes WHERE path >= ? AND path < ?',
+                                   (root, root[:-1] + '0')).fetchall()
+        # sqlite integers are signed
+        return {path: (mtime, size, value & 0xffffffffffffffff) for path, mtime, size, value in rows}
+
+    def put_many(self, entries):
+        """Store [(image_path, mtime, size, hash)]"""
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                                [(path, mtime, size, value - (1 << 64) if value >= 1 << 63 else value) for path, mtime, size, value in entries])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def popcount64(array):
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(array)
+    return numpy.unpackbits(array.view(numpy.uint8)).reshape(len(array), 64).sum(axis=1)
+
+def chunk_near_pairs(values, lo, hi, max_distance):
+    """Yield the index pairs of values which agree on bits lo to hi and differ in at most max_distance bits overall"""
+    mask = (1 << (hi - lo)) - 1
+    numpy = import_numpy()
+    if numpy is not None:
+        hashes = numpy.array(values, dtype=numpy.uint64)
+        chunks = (hashes >> numpy.uint64(lo)) & numpy.uint64(mask)
+        order = numpy.argsort(chunks, kind='stable')
+        chunks, hashes = chunks[order], hashes[order]
+        # sorted by chunk, compare every hash with the one k places further while they are still in the same bucket
+        k = 1
+        active = numpy.nonzero(chunks[:-1] == chunks[1:])[0]
+        while active.size:
+            near = active[popcount64(hashes[active] ^ hashes[active + k]) <= max_distance]
+            yield from zip(order[near].tolist(), order[near + k].tolist())
+            k += 1
+            active = active[active + k < len(chunks)]
+            active = active[chunks[active] == chunks[active + k]]
+        return
+    buckets = {}
+    for i, value in enumerate(values):
+        buckets.setdefault(value >> lo & mask, []).append(i)
+    for bucket in buckets.values():
+        for a in range(len(bucket)):
+            for b in range(a + 1, len(bucket)):
+                if bin(values[bucket[a]] ^ values[bucket[b]]).count('1') <= max_distance:
+                    yield bucket[a], bucket[b]
+
+def hamming_groups(hashes, max_distance=4):
+    """Group the keys of {key: 64 bit hash} whose hashes are at most max_distance bits apart, transitively.
+    Split into max_distance + 1 chunks, two such hashes agree on at least one chunk completely,
+    so only hashes sharing a chunk are ever compared. Returns [[key]] of two or more keys, largest first"""
+    # identical hashes are grouped without any comparison
+    by_hash = {}
+    for key, value in hashes.items():
+        by_hash.setdefault(value, []).append(key)
+    values = list(by_hash)
+    parent = list(range(len(values)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if max_distance > 0 and len(values) > 1:
+        num_chunks = min(max_distance + 1, 64)
+        bounds = [64 * i // num_chunks for i in range(num_chunks + 1)]
+        for lo, hi in zip(bounds, bounds[1:]):
+            for a, b in chunk_near_pairs(values, lo, hi, max_distance):
+                parent[find(a)] = find(b)
+    groups = {}
+    for i, value in enumerate(values):
+        groups.setdefault(find(i), []).extend(by_hash[value])
+    return sorted((sorted(group) for group in groups.values() if len(group) > 1), key=lambda group: (-len(group), group[0]))
+
+def find_near_duplicates(directory, max_distance=4, workers=16, progress=None, cache=None):
+    """Hash every image under directory on a thread pool, reusing the cached hashes of unchanged files,
+    returns the groups of near duplicate image paths, largest first"""
+    known = cache.load(directory) if cache else {}
+    hashes = {}
+    missing = []
+    for path, _ in scan_images(directory):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entry = known.get(path)
+        if entry and entry[:2] == (st.st_mtime_ns, st.st_size):
+            hashes[path] = entry[2]
+        else:
+            missing.append((path, st.st_mtime_ns, st.st_size))
+
+    computed = []
+    with ThreadPoolExecutor(workers) as executor:
+        futures = imap_unordered_bounded(executor, lambda path, mtime, size: (path, mtime, size, dhash(path)), missing, workers * 4)
+        for num_done, future in enumerate(futures, 1):
+            path, mtime, size, value = future.result()
+            if value is not None:
+                hashes[path] = value
+                computed.append((path, mtime, size, value))
+            if progress and num_done % 256 == 0:
+                progress(num_done, len(missing))
+    if cache and computed:
+        cache.put_many(computed)
+    return hamming_groups(hashes, max_distance)
+
+class DuplicatesDialog(QDialog):
+    """Lists groups of near duplicate images, selecting groups selects their images in the tree"""
+
+    def __init__(self, parent, groups):
+        super().__init__(parent)
+        self.setWindowTitle(f'{len(groups)} Groups of Near-Duplicates')
+        self.resize(600, 400)
+        self.select_paths = parent.select_paths
+        self.groups = QListWidget()
+        self.groups.setSelectionMode(QListWidget.ExtendedSelection)
+        for group in groups:
+            item = QListWidgetItem(f'{len(group)} images: ' + ', '.join(os.path.basename(path) for path in group))
+            item.setData(Qt.UserRole, group)
+            item.setToolTip('\n'.join(group))
+            self.groups.addItem(item)
+        self.groups.itemSelectionChanged.connect(self.select_groups)
+        self.select_extra_button = QPushButton('Select All but the First of Each Group')
+        self.select_extra_button.clicked.connect(self.select_extra)
+        close_button = QPushButton('Close')
+        close_button.clicked.connect(self.close)
+        layout = QVBoxLayout()
+        layout.addWidget(self.groups)
+        layout.addLayout(hline(self.select_extra_button, close_button))
+        self.setLayout(layout)
+
+    def select_groups(self):
+        self.select_paths([path for item in self.groups.selectedItems() for path in item.data(Qt.UserRole)])
+
+    def select_extra(self):
+        self.select_paths([path for row in range(self.groups.count()) for path in self.groups.item(row).data(Qt.UserRole)[1:]])
+
+class PerfOverlay(QLabel):
+    """Translucent panel over the main window with the recent span latencies and the cache counters"""
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setStyleSheet('background-color: rgba(0, 0, 0, 180); color: white; padding: 6px;')
+        self.setFont(QFont('Courier New, Monospace', 9))
+        self.setTextFormat(Qt.PlainText)
+        self.timer = QTimer(self)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.refresh)
+        self.hide()
+
+    def toggle(self):
+        if self.isVisible():
+            self.timer.stop()
+            self.hide()
+        else:
+            perf.enabled = True
+            self.refresh()
+            self.show()
+            self.raise_()
+            self.timer.start()
+
+    def refresh(self):
+        lines = [f'{"span":24s} {"count":>7s} {"last":>9s} {"mean":>9s} {"p95":>9s}']
+        for name, (count, last, mean, p95) in sorted(perf.summary().items()):
+            lines.append(f'{name:24s} {count:7d} {last*1000:7.2f}ms {mean*1000:7.2f}ms {p95*1000:7.2f}ms')
+        for name, values in sorted(perf.counter_values().items()):
+            lookups = values.get('hits', 0) + values.get('misses', 0)
+            if lookups:
+                lines.append(f'{name}: {values["hits"]/lookups:.0%} hit rate of {lookups}, {values.get("evictions", 0)} evicted, '
+                             f'{values.get("bytes", 0)/1024/1024:.0f} MB')
+            else:
+                lines.append(f'{name}: ' + ', '.join(f'{key} {value}' for key, value in values.items()))
+        self.setText('\n'.join(lines))
+        self.adjustSize()
+        self.move(self.parent().width() - self.width() - 10, 10)
 
 class ImageTagger(QMainWindow):
     thumbnail_size = 512
+    grid_icon_size = 128
+    prefetch_ahead = 6 # images prefetched in the direction of navigation
+    prefetch_behind = 2 # and against it
+    image_cache_bytes = int(os.environ.get('LITTLETAGGER_CACHE_MB', 512)) * 1024 * 1024
+    session_selection_limit = 10000 # selected paths remembered across a restart
+    session_previews = 24 # previews decoded again after a restart
 
     def __init__(self):
         super().__init__()
@@ -173,21 +2698,43 @@ class ImageTagger(QMainWindow):
         vbox = QVBoxLayout()
 
         # Create a tree view widget to display the list of images in the left panel
-        self.model = QFileSystemModel()
-        self.model.setRootPath("/")
-        self.model.setReadOnly(True)
-        self.model.setNameFilters(['*.jpg', '*.jpeg', '*.png'])
-        self.model.setNameFilterDisables(False)
-        self.tree = QTreeView()
-        self.tree.setColumnWidth(0, 300)
-        self.tree.setModel(self.model)
-        self.tree.setRootIndex(self.model.index("/"))
-        self.tree.setSelectionMode(QTreeView.ExtendedSelection)
-        self.tree.setContextMenuPolicy(Qt.CustomContextMenu)
-        self.tree.customContextMenuRequested.connect(self.filetree_context_menu)
-
-        # Add the tree view widget to the vertical box layout
-        vbox.addWidget(self.tree)
+        # no root path until a directory is chosen, watching / would only cost time at startup
+        self.file_model = QFileSystemModel()
+        self.file_model.setReadOnly(True)
+        self.file_model.setNameFilters(['*.jpg', '*.jpeg', '*.png'])
+        self.file_model.setNameFilterDisables(False)
+        # a flat listing of only the images, for folders too large to browse through the file system model
+        self.dataset_model = DatasetModel(self, lambda path: self.tag_cache.tag_count(path))
+        self.model = self.file_model
+        self.flat_list_action = QAction('Flat Image List', self)
+        self.flat_list_action.setCheckable(True)
+        self.flat_list_action.toggled.connect(self.set_flat_list)
+        self.subfolders_action = QAction('Include Subfolders', self)
+        self.subfolders_action.setCheckable(True)
+        self.subfolders_action.toggled.connect(lambda: self.model is self.dataset_model and self.list_directory())
+        self.file_tree = QTreeView()
+        self.file_tree.setUniformRowHeights(True)
+        self.file_tree.setColumnWidth(0, 300)
+        self.file_tree.setModel(self.file_model)
+        self.file_tree.setSelectionMode(QTreeView.ExtendedSelection)
+        self.dataset_view = DatasetView()
+        self.dataset_view.setModel(self.dataset_model)
+        self.dataset_view.setColumnWidth(0, 300)
+        self.dataset_view.sortByColumn(DatasetModel.NAME, Qt.AscendingOrder)
+        self.dataset_view.hide()
+        # self.tree is whichever of the two is shown
+        self.tree = self.file_tree
+        for view in (self.file_tree, self.dataset_view):
+            view.setContextMenuPolicy(Qt.CustomContextMenu)
+            view.customContextMenuRequested.connect(self.filetree_context_menu)
+            # Add the tree view widget to the vertical box layout
+            vbox.addWidget(view)
+
+        # Progress of the background tag scan
+        self.scan_progress = QProgressBar()
+        self.scan_progress.setFormat('Reading tags %v / %m')
+        self.scan_progress.hide()
+        vbox.addWidget(self.scan_progress)
 
         # Create a button widget to choose directory
         self.choose_dir_button = QPushButton('Choose Directory')
@@ -207,39 +2754,57 @@ class ImageTagger(QMainWindow):
         self.label.setAlignment(Qt.AlignCenter)
         self.label.setMinimumSize(512, 512) # Set the minimum size of the label widget to 512x512
 
-        right_panel = QSplitter(Qt.Vertical)
+        right_panel = self.right_panel = QSplitter(Qt.Vertical)
         right_panel_down = QWidget()
         right_panel_down_layout = QVBoxLayout()
         right_panel.addWidget(self.label)
 
-        self.thumbnail_list = QListWidget()
+        self.icon_cache = PixmapCache(64*1024*1024) # {image_path: grid icon pixmap}
+        self.thumbnail_model = ThumbnailGridModel(self, self.icon_cache, self.request_grid_icon, self.grid_icon_size)
+        self.thumbnail_list = QListView()
+        self.thumbnail_list.setModel(self.thumbnail_model)
         self.thumbnail_list.setMinimumSize(512, 600)
-        self.thumbnail_list.setFlow(QListWidget.LeftToRight)
-        self.thumbnail_list.setResizeMode(QListWidget.Adjust)
-        self.thumbnail_list.setViewMode(QListWidget.IconMode)
-        self.thumbnail_list.setIconSize(QSize(128, 128))
-        self.thumbnail_list.setGridSize(QSize(138, 158))
-        self.thumbnail_list.setMovement(QListWidget.Static)
-        self.thumbnail_list.setSelectionMode(QListWidget.ExtendedSelection)
-        self.thumbnail_list.itemDoubleClicked.connect(self.thumbnail_double_clicked)
+        self.thumbnail_list.setFlow(QListView.LeftToRight)
+        self.thumbnail_list.setResizeMode(QListView.Adjust)
+        self.thumbnail_list.setViewMode(QListView.IconMode)
+        self.thumbnail_list.setIconSize(QSize(self.grid_icon_size, self.grid_icon_size))
+        self.thumbnail_list.setGridSize(QSize(self.grid_icon_size + 10, self.grid_icon_size + 30))
+        self.thumbnail_list.setUniformItemSizes(True)
+        self.thumbnail_list.setLayoutMode(QListView.Batched)
+        self.thumbnail_list.setMovement(QListView.Static)
+        self.thumbnail_list.setSelectionMode(QListView.ExtendedSelection)
+        self.thumbnail_list.doubleClicked.connect(self.thumbnail_double_clicked)
         self.thumbnail_list.keyPressEvent = self.thumbnail_key_pressed
         self.thumbnail_list.selectionModel().selectionChanged.connect(self.on_thumbnail_selection_changed)
+        # after scrolling settles, decode what is in and near the viewport first
+        self.grid_prefetch_timer = QTimer(self)
+        self.grid_prefetch_timer.setSingleShot(True)
+        self.grid_prefetch_timer.setInterval(100)
+        self.grid_prefetch_timer.timeout.connect(self.prefetch_grid_icons)
+        self.thumbnail_list.verticalScrollBar().valueChanged.connect(self.grid_prefetch_timer.start)
         right_panel.addWidget(self.thumbnail_list)
         self.thumbnail_list.hide()
 
         taglist_layout = QVBoxLayout()
         tagpool_layout = QVBoxLayout()
 
-        self.taglist = QListWidget()
-        self.tagpool = QListWidget()
+        self.taglist_model = TagListModel(self)
+        self.tagpool_model = TagListModel(self, keep_sorted=True)
+        self.taglist = QListView()
+        self.taglist.setModel(self.taglist_model)
+        self.tagpool = QListView()
+        self.tagpool.setModel(self.tagpool_model)
+        self.tagpool.setUniformItemSizes(True)
+        self.tagpool.setItemDelegate(TagHighlightDelegate(self.taglist_model.__contains__, self.partial_tag_count, self.tagpool))
 
         taglist_layout.addWidget(QLabel('Common Tags of Selection'))
         taglist_layout.addWidget(self.taglist)
 
         self.taglist.setDragDropMode(QListView.InternalMove)
         self.taglist.setSelectionMode(QListView.ExtendedSelection)
-        self.taglist.itemDoubleClicked.connect(self.move_tag_to_pool)
-        self.tagpool.itemDoubleClicked.connect(self.move_tag_to_list)
+        self.tagpool.setSelectionMode(QListView.ExtendedSelection)
+        self.taglist.doubleClicked.connect(self.move_tag_to_pool)
+        self.tagpool.doubleClicked.connect(self.move_tag_to_list)
         self.tagpool.setContextMenuPolicy(Qt.CustomContextMenu)
         self.tagpool.customContextMenuRequested.connect(self.tagpool_context_menu)
 
@@ -257,6 +2822,10 @@ class ImageTagger(QMainWindow):
 
         self.tags_edit = QLineEdit()
         self.tags_edit.setPlaceholderText('Add tags here')
+        self.tag_completer = TagCompleter(self.tagpool_model, lambda tag: self.tag_cache.count(tag), self)
+        self.tag_completer.setWidget(self.tags_edit)
+        self.tag_completer.activated[str].connect(self.tags_edit.setText)
+        self.tags_edit.textEdited.connect(self.tag_completer.show_matches)
         self.tags_edit.returnPressed.connect(lambda: self.add_tag(self.tags_edit.text()) or self.tags_edit.setText('') or self.highlight_pool())
         hbox = QHBoxLayout()
         hbox.addWidget(self.tags_edit)
@@ -273,53 +2842,99 @@ class ImageTagger(QMainWindow):
         self.splitter.addWidget(right_panel)
 
         # Connect the tree view widget's selectionChanged signal to the on_tree_selection_changed function
-        self.tree.selectionModel().selectionChanged.connect(self.on_tree_selection_changed)
+        self.file_tree.selectionModel().selectionChanged.connect(self.on_tree_selection_changed)
+        self.dataset_view.selectionModel().selectionChanged.connect(self.on_tree_selection_changed)
 
         # Set the splitter widget as the central widget of the main window
         self.setCentralWidget(self.splitter)
 
-        self.current_images = {} # {image_path: imagerecord}
+        self.current_images = SelectionTags() # {image_path: imagerecord}, with a count of each tag
         self.common_tags = set() # common set of tags for all selected images
-        self.tag_cache = {} # {image_path: set(tags)}
-        self.filepath_cache = {} # {image_path: fullpath}
-        self.image_cache = {} # {image_path: pixmap}
+        self.selection_from_tree = False # whether current_images follows the tree selection, or a part of the grid
+        self.tag_cache = TagIndex() # {image_path: (tags)}, with the reverse {tag: set(image_paths)}
+        self.image_cache = PixmapCache(self.image_cache_bytes) # {image_path: pixmap}
+
+        try:
+            self.disk_cache = DiskThumbnailCache(os.path.join(default_cache_dir(), 'thumbnails'))
+        except (OSError, sqlite3.Error) as e:
+            self.statusBar().showMessage(f'Thumbnail cache disabled: {e}')
+            self.disk_cache = None
+        self.thumbnail_loader = ThumbnailLoader(self, self.disk_cache)
+        self.thumbnail_loader.thumbnail_loaded.connect(self.on_thumbnail_loaded)
+        self.hash_cache = None # opened on the first near duplicate search
+        self.import_edits = None # {image_path: tags} edited while a tag database import runs
+
+        self.current_directory = None
+        self.pending_selection = None # (paths, current path, preview paths) of a restored session, until the listing and the tags are there
+        self.pending_listed = False # whether the rows of pending_selection are listed yet
+        self.file_model.directoryLoaded.connect(lambda: self.restore_selection(True))
+        self.dataset_model.walk_finished.connect(lambda generation: self.restore_selection(True))
+        self.nav_direction = 1 # +1 after Ctrl+N, -1 after Ctrl+P
+        self.nav_streak = 0 # steps in a row in nav_direction
+        self.tag_database = None
+        self.tasks = set() # running BackgroundTasks
+        self.tag_writer = TagWriter(self)
+        self.tag_writer.write_failed.connect(self.on_tag_write_failed)
+
+        # F12 shows recent latencies, enabling the instrumentation if it was off
+        self.perf_overlay = PerfOverlay(self)
+        perf.counters['image_cache'] = self.image_cache.stats
+        perf.counters['icon_cache'] = self.icon_cache.stats
+        perf.counters['queues'] = lambda: {'decodes': len(self.thumbnail_loader.pending), 'writes': len(self.tag_writer.pending)}
+        overlay_action = QAction('Performance Overlay', self)
+        overlay_action.setShortcut(QKeySequence(Qt.Key_F12))
+        overlay_action.triggered.connect(self.perf_overlay.toggle)
+        self.addAction(overlay_action)
+        export_trace_action = QAction('Export Performance Trace ...', self)
+        export_trace_action.setShortcut(QKeySequence(Qt.CTRL + Qt.SHIFT + Qt.Key_F12))
+        export_trace_action.triggered.connect(self.export_trace)
+        self.addAction(export_trace_action)
+
+        self.tag_scanner = TagScanner(self)
+        self.tag_scanner.tags_loaded.connect(self.on_tags_loaded)
+        self.tag_scanner.progress.connect(self.on_scan_progress)
+        self.tag_scanner.finished.connect(lambda generation: self.scan_progress.hide())
+        self.tag_scanner.finished.connect(lambda generation: self.restore_selection())
+
+    def export_trace(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export Performance Trace', 'littletagger-trace.json', 'Trace (*.json)')
+        if path:
+            perf.export_trace(path)
+            self.statusBar().showMessage(f'{len(perf.events)} spans written to {path}', 5000)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.perf_overlay.isVisible():
+            self.perf_overlay.refresh()
 
     def highlight_pool(self):
-        for item in self.tagpool.findItems('', Qt.MatchContains):
-            if self.taglist.findItems(item.text(), Qt.MatchExactly):
-                item.setBackground(QColor(200, 200, 200))
-            else:
-                item.setBackground(QColor(255, 255, 255))
+        # the delegate looks the highlight up while painting, so only the visible rows need a repaint
+        with perf.span('highlight_pool'):
+            self.tagpool.viewport().update()
 
-    def move_tag_to_pool(self, item):
-        if not self.tagpool.findItems(item.text(), Qt.MatchExactly):
-            self.tagpool.addItem(item.text())
-            self.tagpool.sortItems()
-        self.taglist.takeItem(self.taglist.row(item))
+    def move_tag_to_pool(self, index):
+        self.tagpool_model.add(index.data())
+        self.taglist_model.removeRows(index.row(), 1)
         self.highlight_pool()
 
-    def move_tag_to_list(self, item):
-        if not self.taglist.findItems(item.text(), Qt.MatchExactly):
-            self.taglist.addItem(item.text())
+    def move_tag_to_list(self, index):
+        self.taglist_model.add(index.data())
         self.highlight_pool()
 
     def taglist_key_pressed(self, event):
         if event.key() == Qt.Key_Delete:
-            for item in self.taglist.selectedItems():
-                self.taglist.takeItem(self.taglist.row(item))
+            self.taglist_model.remove_rows(index.row() for index in self.taglist.selectionModel().selectedRows())
             self.highlight_pool()
         else:
             QListView.keyPressEvent(self.taglist, event)
 
     def tagpool_key_pressed(self, event):
         if event.key() == Qt.Key_Delete:
-            for item in self.tagpool.selectedItems():
-                self.tagpool.takeItem(self.tagpool.row(item))
+            self.tagpool_model.remove_rows(index.row() for index in self.tagpool.selectionModel().selectedRows())
             self.highlight_pool()
         elif event.key() == Qt.Key_Enter or event.key() == Qt.Key_Return:
-            for item in self.tagpool.selectedItems():
-                if not self.taglist.findItems(item.text(), Qt.MatchExactly):
-                    self.taglist.addItem(item.text())
+            for index in self.tagpool.selectionModel().selectedRows():
+                self.taglist_model.add(index.data())
             self.highlight_pool()
         else:
             QListView.keyPressEvent(self.tagpool, event)
@@ -327,18 +2942,71 @@ class ImageTagger(QMainWindow):
     def thumbnail_key_pressed(self, event):
         if event.key() == Qt.Key_Enter or event.key() == Qt.Key_Return:
             selection = QItemSelection()
-            for index in self.find_index_by_basename([item.text() for item in self.thumbnail_list.selectedItems()]):
-                selection.merge(QItemSelection(index, index), QItemSelectionModel.Select)
+            for index in self.thumbnail_list.selectionModel().selectedRows():
+                index = self.model.index(index.data(Qt.UserRole))
+                if index.isValid():
+                    selection.select(index, index)
             if selection:
                 self.tree.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
-                self.on_tree_selection_changed(None)
 
     def tagpool_context_menu(self, pos):
         menu = QMenu()
-        current_tag = self.tagpool.currentItem().text()
-        select_action = QAction(f'Select all images with tag {current_tag}', self)
-        select_action.triggered.connect(lambda: self.select_images_with_tag(current_tag))
-        menu.addAction(select_action)
+        if self.tagpool.currentIndex().isValid():
+            current_tag = self.tagpool.currentIndex().data()
+            select_action = QAction(f'Select all images with tag {current_tag} ({self.tag_cache.count(current_tag)})', self)
+            select_action.triggered.connect(lambda: self.select_images_with_tag(current_tag))
+            menu.addAction(select_action)
+            select_without_action = QAction(f'Select all images without tag {current_tag}', self)
+            select_without_action.triggered.connect(lambda: self.select_images_by_query(none_of=[current_tag]))
+            menu.addAction(select_without_action)
+
+        selected_tags = [index.data() for index in self.tagpool.selectionModel().selectedRows()]
+        if len(selected_tags) > 1:
+            select_all_action = QAction(f'Select images with all {len(selected_tags)} selected tags', self)
+            select_all_action.triggered.connect(lambda: self.select_images_by_query(all_of=selected_tags))
+            menu.addAction(select_all_action)
+            select_any_action = QAction(f'Select images with any of the {len(selected_tags)} selected tags', self)
+            select_any_action.triggered.connect(lambda: self.select_images_by_query(any_of=selected_tags))
+            menu.addAction(select_any_action)
+            select_none_action = QAction(f'Select images with none of the {len(selected_tags)} selected tags', self)
+            select_none_action.triggered.connect(lambda: self.select_images_by_query(none_of=selected_tags))
+            menu.addAction(select_none_action)
+
+        if self.tagpool.currentIndex().isValid() and self.current_directory:
+            menu.addSeparator()
+            # the images carrying a tag are only all known once the scan is through
+            tags_complete = self.tag_database is not None or self.tag_scanner.complete
+            rename_action = QAction(f'Rename {current_tag} in all images ...', self)
+            rename_action.triggered.connect(lambda: self.rename_tag_everywhere(current_tag))
+            rename_action.setEnabled(tags_complete)
+            menu.addAction(rename_action)
+            delete_action = QAction(f'Delete {current_tag} from all images ...', self)
+            delete_action.triggered.connect(lambda: self.delete_tags_everywhere([current_tag]))
+            delete_action.setEnabled(tags_complete)
+            menu.addAction(delete_action)
+            if len(selected_tags) > 1:
+                merge_action = QAction(f'Merge the {len(selected_tags)} selected tags in all images ...', self)
+                merge_action.triggered.connect(lambda: self.merge_tags_everywhere(selected_tags))
+                merge_action.setEnabled(tags_complete)
+                menu.addAction(merge_action)
+                delete_selected_action = QAction(f'Delete the {len(selected_tags)} selected tags from all images ...', self)
+                delete_selected_action.triggered.connect(lambda: self.delete_tags_everywhere(selected_tags))
+                delete_selected_action.setEnabled(tags_complete)
+                menu.addAction(delete_selected_action)
+        journal_path = self.current_directory and latest_tag_journal(self.current_directory)
+        if journal_path and not self.tasks:
+            try:
+                description = read_tag_journal(journal_path)[0]
+            except (OSError, ValueError, KeyError):
+                description = os.path.basename(journal_path)
+            undo_action = QAction(f'Undo {description}', self)
+            undo_action.triggered.connect(lambda: self.undo_bulk_tag_edit(journal_path))
+            menu.addAction(undo_action)
+        menu.addSeparator()
+
+        expression_action = QAction('Select by tag expression ...', self)
+        expression_action.triggered.connect(self.select_images_by_expression)
+        menu.addAction(expression_action)
 
         refresh_action = QAction('Refresh tag pool', self)
         refresh_action.triggered.connect(self.refresh_tagpool)
@@ -359,128 +3027,481 @@ class ImageTagger(QMainWindow):
         resize_dlg_action = QAction('Resize / Crop Selected Items ...', self)
         resize_dlg_action.triggered.connect(show_crop_dlg)
         menu.addAction(resize_dlg_action)
+
+        if self.current_directory:
+            database_menu = menu.addMenu('Tag Database')
+            import_action = QAction('Import Sidecars into Tag Database' if self.tag_database else 'Create Tag Database from Sidecars', self)
+            import_action.triggered.connect(self.import_tag_database)
+            database_menu.addAction(import_action)
+            if self.tag_database:
+                export_action = QAction('Export Tag Database to Sidecars', self)
+                export_action.triggered.connect(self.export_tag_database)
+                database_menu.addAction(export_action)
+                disable_action = QAction('Export and Stop Using the Tag Database', self)
+                disable_action.triggered.connect(self.disable_tag_database)
+                database_menu.addAction(disable_action)
+
+        if self.current_directory:
+            duplicates_action = QAction('Find Near-Duplicates ...', self)
+            duplicates_action.triggered.connect(self.find_duplicates)
+            menu.addAction(duplicates_action)
+            export_action = QAction('Export Tar Shards ...', self)
+            export_action.triggered.connect(self.export_tar_shards)
+            menu.addAction(export_action)
+
+        menu.addSeparator()
+        menu.addAction(self.flat_list_action)
+        if self.flat_list_action.isChecked():
+            menu.addAction(self.subfolders_action)
         menu.exec_(self.tree.viewport().mapToGlobal(pos))
 
+    def run_task(self, function, on_finished, message, on_failed=None):
+        """Run function(progress) in the background, with the progress shown under the tree,
+        on_failed gets the exception it raised after it was reported"""
+        self.statusBar().showMessage(message)
+        self.scan_progress.setRange(0, 0)
+        self.scan_progress.show()
+        task = BackgroundTask(function, self)
+        self.tasks.add(task)
+        task.progress.connect(self.on_scan_progress)
+
+        def finished(result):
+            self.tasks.discard(task)
+            self.scan_progress.hide()
+            self.statusBar().clearMessage()
+            if isinstance(result, Exception):
+                QMessageBox.warning(self, 'Error', f'{message} failed: {result}')
+                if on_failed:
+                    on_failed(result)
+            else:
+                on_finished(result)
+        task.finished.connect(finished)
+        return task.start()
+
+    def import_tag_database(self):
+        self.save_current_tags()
+        self.tag_writer.flush()
+        directory = self.current_directory
+        path = tag_database_path(directory)
+        # a new store is built aside and moved into place when complete, a half imported one would be taken as the truth
+        tmp_path = None if self.tag_database else f'{path}.{os.getpid()}.tmp'
+        database = self.tag_database or TagDatabase(directory, tmp_path)
+        # the import may read a sidecar before an edit made meanwhile reaches it, those edits go over the import
+        self.import_edits = {}
+
+        def run(progress):
+            try:
+                return database.import_sidecars(progress=progress)
+            except BaseException:
+                if tmp_path:
+                    database.close()
+                    for suffix in ('', '-wal', '-shm'):
+                        if os.path.exists(tmp_path + suffix):
+                            os.remove(tmp_path + suffix)
+                raise
+
+        def imported(count):
+            self.tag_writer.flush()
+            edits, self.import_edits = self.import_edits, None
+            database.put_many({image_path: tags for image_path, tags in edits.items() if image_path.startswith(database.root + '/')})
+            if tmp_path:
+                database.close()
+                os.replace(tmp_path, path)
+            self.statusBar().showMessage(f'{count} images imported into the tag database', 5000)
+            if directory == self.current_directory:
+                self.switch_directory(directory)
+        self.run_task(run, imported, 'Importing sidecars', lambda error: setattr(self, 'import_edits', None))
+
+    def export_tag_database(self, on_exported=None):
+        self.save_current_tags()
+        self.tag_writer.flush()
+
+        def exported(count):
+            self.statusBar().showMessage(f'{count} sidecars written from the tag database', 5000)
+            if on_exported:
+                on_exported()
+        self.run_task(self.tag_database.export_sidecars, exported, 'Exporting sidecars')
+
+    def disable_tag_database(self):
+        if QMessageBox.question(self, 'Stop Using the Tag Database',
+                                'Write all tags back into the sidecars and delete the tag database?') != QMessageBox.Yes:
+            return
+        database = self.tag_database
+
+        def remove_database():
+            if database is self.tag_database:
+                self.tag_writer.set_database(None)
+                self.tag_database = None
+            database.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(database.path + suffix):
+                    os.remove(database.path + suffix)
+            if self.current_directory:
+                self.switch_directory(self.current_directory)
+        self.export_tag_database(remove_database)
+
+    def rename_tag_everywhere(self, tag):
+        new_tag, ok = QInputDialog.getText(self, 'Rename Tag', f'Rename {tag} in {self.tag_cache.count(tag)} images to:', text=tag)
+        new_tag = new_tag.strip()
+        if ok and new_tag and new_tag != tag:
+            self.bulk_edit_tags({tag: new_tag}, f'rename of {tag} to {new_tag}')
+
+    def merge_tags_everywhere(self, tags):
+        new_tag, ok = QInputDialog.getItem(self, 'Merge Tags', f'Replace {", ".join(tags)} in all images by:', tags, 0, True)
+        new_tag = new_tag.strip()
+        if ok and new_tag:
+            self.bulk_edit_tags({tag: new_tag for tag in tags}, f'merge of {", ".join(tags)} into {new_tag}')
+
+    def delete_tags_everywhere(self, tags):
+        num_images = len(set().union(*(self.tag_cache.paths_with(tag) for tag in tags)))
+        if QMessageBox.question(self, 'Delete Tags', f'Delete {", ".join(tags)} from {num_images} images?') == QMessageBox.Yes:
+            self.bulk_edit_tags({tag: None for tag in tags}, f'deletion of {", ".join(tags)}')
+
+    def bulk_edit_tags(self, renames, description):
+        """Rename or delete tags in every image carrying them, the images are found through tag_cache
+        but their tags are read again from disk, which may have changed behind its back"""
+        self.save_current_tags()
+        self.tag_writer.flush()
+        paths = set().union(*(self.tag_cache.paths_with(tag) for tag in renames))
+        if not paths:
+            return
+        directory = self.current_directory
+        database = self.tag_database
+        cached = {path: self.tag_cache[path] for path in paths}
+
+        def edit(progress):
+            changes = rename_tags_many(paths, renames, database, progress=progress)
+            if not changes:
+                return changes, {}
+            write_tag_journal(directory, description, changes)
+            # a file edited since it was read keeps that edit, it is reported instead
+            return changes, write_tags_many({path: new_tags for path, (_, new_tags) in changes.items()}, database, progress=progress,
+                                            expected={path: old_tags for path, (old_tags, _) in changes.items()})
+        self.run_task(edit, lambda result: self.bulk_tags_written(*result, description, cached), f'Writing the {description}')
+
+    def undo_bulk_tag_edit(self, journal_path):
+        self.save_current_tags()
+        self.tag_writer.flush()
+        description, entries = read_tag_journal(journal_path)
+        # images whose tags changed again since are left alone
+        changes = {path: (new_tags, old_tags) for path, old_tags, new_tags in entries if list(self.tag_cache.get(path, ())) == new_tags}
+        skipped = len(entries) - len(changes)
+
+        def undo(progress):
+            failed = write_tags_many({path: old_tags for path, (_, old_tags) in changes.items()}, self.tag_database, progress=progress)
+            if not failed:
+                os.replace(journal_path, journal_path + '.undone')
+            return failed
+
+        def undone(failed):
+            self.bulk_tags_written(changes, failed, f'undo of the {description}')
+            if skipped:
+                QMessageBox.information(self, 'Undo', f'{skipped} images were left as they are, their tags were changed again since.')
+        self.run_task(undo, undone, f'Undoing the {description}')
+
+    def bulk_tags_written(self, changes, failed, description, cached=None):
+        """Bring tag_cache, the tag pool and the selection up to date after a bulk edit, in one go,
+        cached is {image_path: tags} of tag_cache when the edit started, the old tags of changes if None"""
+        # edits made to the selection in the meantime are saved first, they are written after the bulk edit and stay
+        self.save_current_tags()
+        failed_paths = set(failed)
+        added_tags = set()
+        removed_tags = set()
+        num_edited = 0
+        for path, (old_tags, new_tags) in changes.items():
+            if sidecar_path(path) in failed_paths:
+                continue
+            if list(self.tag_cache.get(path, ())) != list(cached[path] if cached is not None else old_tags):
+                num_edited += 1
+                continue
+            self.tag_cache[path] = new_tags
+            if self.import_edits is not None:
+                self.import_edits[path] = new_tags
+            added_tags.update(new_tags)
+            removed_tags.update(old_tags)
+        self.tagpool_model.add_many(added_tags)
+        for tag in removed_tags - added_tags:
+            if not self.tag_cache.count(tag):
+                self.tagpool_model.remove(tag)
+        if self.model is self.dataset_model:
+            self.dataset_model.tags_changed(changes)
+        self.update_active_images(list(self.current_images), (), False)
+        self.statusBar().showMessage(f'{len(changes) - len(failed) - num_edited} images changed by the {description}', 5000)
+        if num_edited:
+            QMessageBox.information(self, 'Tags Edited Meanwhile', f'{num_edited} images were edited while the {description} ran, they keep that edit.')
+        if failed:
+            errors = '\n'.join(f'{tag_path}: {error}' for tag_path, error in list(failed.items())[:20])
+            QMessageBox.warning(self, 'Tags Not Saved', f'{len(failed)} tag files were not saved:\n{errors}')
+
+    def find_duplicates(self):
+        max_distance, ok = QInputDialog.getInt(self, 'Find Near-Duplicates', 'Most bits out of 64 two perceptual hashes may differ in:', 4, 0, 8)
+        if not ok:
+            return
+        if self.hash_cache is None:
+            try:
+                self.hash_cache = HashCache(os.path.join(default_cache_dir(), 'hashes.sqlite'))
+            except (OSError, sqlite3.Error) as e:
+                self.statusBar().showMessage(f'Perceptual hash cache disabled: {e}')
+        directory = self.current_directory
+        cache = self.hash_cache
+
+        def found(groups):
+            if not groups:
+                self.statusBar().showMessage('No near-duplicates found', 5000)
+                return
+            DuplicatesDialog(self, groups).show()
+        self.run_task(lambda progress: find_near_duplicates(directory, max_distance, progress=progress, cache=cache),
+                      found, 'Looking for near-duplicates')
+
+    def export_tar_shards(self):
+        """Export the selected images, or the whole directory if at most one is selected, into tar shards with their tags"""
+        self.save_current_tags()
+        selected = [self.model.filePath(index) for index in self.tree.selectionModel().selectedRows() if self.is_image_file(index)]
+        directory = self.current_directory
+        dialog = ExportShardsDialog(self, directory, len(selected) if len(selected) > 1 else len(self.tag_cache))
+        if not dialog.exec_():
+            return
+        out_dir = dialog.out_dir_edit.text()
+        shard_samples = dialog.shard_samples.value()
+        crop_size = dialog.crop_size()
+        workers = dialog.num_workers.value()
+        # the tags as shown, only the sidecars the scan hasn't got to yet are read
+        known = dict(self.tag_cache.items())
+
+        def export(progress):
+            paths = selected if len(selected) > 1 else sorted(path for path, _ in scan_images(directory))
+            return export_shards([(path, known.get(path)) for path in paths], out_dir, shard_samples, crop_size, workers, progress=progress)
+
+        def exported(result):
+            entries, failed = result
+            message = f'{sum(len(entry["sources"]) for entry in entries)} images written into {len(entries)} shards in {out_dir}'
+            if failed:
+                details = '\n'.join(f'{path}: {error}' for path, error in failed[:20])
+                QMessageBox.warning(self, 'Export Tar Shards', f'{message}, {len(failed)} failed:\n{details}')
+            else:
+                self.statusBar().showMessage(message, 5000)
+        self.run_task(export, exported, 'Exporting tar shards')
+
     def select_images_with_tag(self, tag):
+        self.select_paths(self.tag_cache.paths_with(tag))
+
+    def select_images_by_query(self, all_of=(), any_of=(), none_of=()):
+        self.select_paths(self.tag_cache.query(all_of, any_of, none_of))
+
+    def select_images_by_expression(self):
+        expression, ok = QInputDialog.getText(self, 'Select by Tags', 'Tag expression, e.g. `a & (b | c) & !d`:')
+        if not ok or not expression.strip():
+            return
+        try:
+            paths = self.tag_cache.evaluate(expression)
+        except ValueError as e:
+            QMessageBox.warning(self, 'Invalid Tag Expression', str(e))
+            return
+        self.select_paths(paths)
+
+    def select_paths(self, paths):
         selection = QItemSelection()
-        for path in self.tag_cache:
-            if tag in self.tag_cache[path]:
-                index = self.model.index(path)
-                if index.isValid():
-                    selection.merge(QItemSelection(index, index), QItemSelectionModel.Select)
+        for path in paths:
+            index = self.model.index(path)
+            if index.isValid():
+                selection.select(index, index)
         self.tree.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
-        self.on_tree_selection_changed(None)
 
     def refresh_tagpool(self):
-        self.tagpool.clear()
-        all_tags = set()
-        for tags in self.tag_cache.values():
-            for tag in tags:
-                all_tags.add(tag)
-        for tag in all_tags:
-            self.tagpool.addItem(tag)
-        self.tagpool.sortItems()
+        with perf.span('tagpool.rebuild'):
+            self.tagpool_model.set_tags(self.tag_cache.tags())
         self.highlight_pool()
 
+    def on_scan_progress(self, done, total):
+        self.scan_progress.setRange(0, total)
+        self.scan_progress.setValue(done)
+
+    def on_tag_write_failed(self, tag_path, error):
+        self.statusBar().showMessage(f'Failed to save {tag_path}: {error}')
+
+    def on_tags_loaded(self, generation, started, batch):
+        if generation != self.tag_scanner.generation:
+            # queued before the directory was switched, the paths belong to the previous one
+            return
+        new_tags = set()
+        changed_current = []
+        # read before our own edit got written, tag_cache already has the newer tags
+        superseded = self.tag_writer.superseded(batch, started)
+        for path, tags in batch.items():
+            if path in superseded:
+                continue
+            if tags is None:
+                self.tag_cache.discard(path)
+                continue
+            appeared = self.tag_cache.set(path, tags)
+            if appeared is None:
+                continue
+            new_tags.update(appeared)
+            if path in self.current_images:
+                changed_current.append(path)
+        if new_tags:
+            self.tagpool_model.add_many(new_tags)
+            self.highlight_pool()
+        if self.model is self.dataset_model:
+            self.dataset_model.update(batch)
+        if changed_current:
+            # a sidecar of the selection was changed outside, show what is on disk now
+            self.update_active_images(changed_current, (), False)
+
     def add_tag(self, tag):
-        if not self.taglist.findItems(tag, Qt.MatchExactly):
-            self.taglist.addItem(tag)
-        if not self.tagpool.findItems(tag, Qt.MatchExactly):
-            self.tagpool.addItem(tag)
-            self.tagpool.sortItems()
+        tag = tag.strip()
+        if not tag:
+            return
+        self.taglist_model.add(tag)
+        self.tagpool_model.add(tag)
 
     def save_current_tags(self):
-        current_tags = [tag.text() for tag in self.taglist.findItems('', Qt.MatchContains)]
+        current_tags = list(self.taglist_model.tags)
         removed_common_tags = (self.common_tags or set()) - set(current_tags)
         added_common_tags = set(current_tags) - (self.common_tags or set())
-        print(f'removed common tags: {removed_common_tags}')
+        # tag_cache is updated right away, the files or the tag database are written behind by tag_writer
         if len(self.current_images) == 1:
-            path = list(self.current_images.keys())[0]
-            tags = self.current_images[path].tags
-            if tags != current_tags:
-                self.tag_cache[path] = set(current_tags)
-                with open(self.current_images[path].tag_path, 'w') as f:
-                    f.write(', '.join(current_tags))
-                    print(f'tags for {os.path.basename(path)} saved')
+            record = list(self.current_images.values())[0]
+            if record.tags != current_tags:
+                self.tag_cache[record.path] = current_tags
+                self.tag_writer.write(record.path, current_tags)
+                if self.import_edits is not None:
+                    self.import_edits[record.path] = current_tags
+                self.current_images.add(record._replace(tags=current_tags))
+        elif added_common_tags or removed_common_tags:
+            changed = {}
+            for record in self.current_images.values():
+                tags = apply_tag_changes(record.tags, added_common_tags, removed_common_tags)
+                if tags != record.tags:
+                    changed[record.path] = tags
+            # in bulk, a large selection would take an index update, a lock and a recount per image otherwise
+            self.tag_cache.set_many(changed)
+            self.tag_writer.write_many(changed)
+            if self.import_edits is not None:
+                self.import_edits.update(changed)
+            self.current_images.change_common(changed, added_common_tags, removed_common_tags)
         else:
-            for path in self.current_images:
-                tags = self.current_images[path].tags.copy()
-                for tag in added_common_tags:
-                    if tag not in tags:
-                        tags.append(tag)
-                for tag in removed_common_tags:
-                    if tag in tags:
-                        tags.remove(tag)
-                if tags != self.current_images[path].tags:
-                    self.tag_cache[path] = set(tags)
-                    with open(self.current_images[path].tag_path, 'w') as f:
-                        f.write(', '.join(tags))
-                        print(f'tags for {os.path.basename(path)} saved')
-                else:
-                    print(f'{os.path.basename(path)}: no changes')
+            return
+        self.common_tags = set(current_tags)
+        if self.model is self.dataset_model:
+            self.dataset_model.tags_changed(self.current_images)
+
+    def image_record(self, path):
+        tag_path = sidecar_path(path)
+        try:
+            # the tag scanner keeps tag_cache in sync with the sidecars, only read the ones it hasn't got to yet
+            if path in self.tag_cache:
+                tags = list(self.tag_cache[path])
+            else:
+                tags = read_sidecar(tag_path)
+                self.tag_cache[path] = tags
+        except FileNotFoundError:
+            tags = []
+            self.tag_cache[path] = set()
+        return ImageRecord(path, tag_path, tags)
 
     def set_active_images(self, paths, reset_preview=True):
         self.save_current_tags()
+        self.current_images.clear()
+        self.update_active_images(paths, (), reset_preview)
 
-        self.common_tags = None
-        self.current_images = {}
-        all_tags = set()
-        processed_files = set()
-        for path in paths:
-            if path not in self.image_cache:
-                self.image_cache[path] = QPixmap(path).scaledToWidth(self.thumbnail_size)
-            self.filepath_cache[os.path.basename(path)] = path
-            if path in processed_files: # skip duplicates, as multiple indices can point to the same file
-                continue
-            processed_files.add(path)
-            tag_path = os.path.splitext(path)[0] + '.txt'
-            try:
-                tags = [tag.strip() for tag in open(tag_path).read().split(',')]
-                tagset = set(tags)
-                self.tag_cache[path] = tagset
-                all_tags = all_tags.union(tagset)
-                if self.common_tags is None:
-                    self.common_tags = tagset
-                else:
-                    self.common_tags = self.common_tags.intersection(tagset)
-                self.current_images[path] = ImageRecord(path, tag_path, tags)
-            except FileNotFoundError:
-                self.current_images[path] = ImageRecord(path, tag_path, [])
-
-        for tag in all_tags:
-            if not self.tagpool.findItems(tag, Qt.MatchExactly):
-                self.tagpool.addItem(tag)
-        self.tagpool.clearSelection()
-        self.tagpool.sortItems()
-        self.taglist.clear()
-        self.taglist.clearSelection()
-        for tag in self.common_tags or []:
-            self.taglist.addItem(tag)
+    def update_active_images(self, added, removed, reset_preview=True):
+        """Add images to and remove images from the selection, only the added sidecars are looked at,
+        an added image already in the selection is read again"""
+        self.save_current_tags()
+
+        for path in removed:
+            self.current_images.remove(path)
+        records = [self.image_record(path) for path in dict.fromkeys(added)] # skip duplicates, as multiple indices can point to the same file
+        # counting a large batch on the tag index's arrays beats adding up every image's tags
+        counts = self.tag_cache.histogram([record.path for record in records]) if len(records) > 256 else None
+        self.current_images.add_many(records, counts)
+        new_tags = counts.keys() if counts is not None else {tag for record in records for tag in record.tags}
+        self.common_tags = self.current_images.common()
+
+        with perf.span('taglist.rebuild'):
+            self.tagpool_model.add_many(new_tags)
+            self.tagpool.clearSelection()
+            self.taglist.clearSelection()
+            if len(self.current_images) == 1:
+                # keep the order of the sidecar, so it's only rewritten when something changed
+                self.taglist_model.set_tags(list(self.current_images.values())[0].tags)
+            else:
+                self.taglist_model.set_tags(self.common_tags)
         self.highlight_pool()
 
         if reset_preview:
+            # drop decodes still queued for the previous selection
+            self.thumbnail_loader.cancel()
             self.label.clear()
             if len(self.current_images)==1:
-                self.label.setPixmap(self.image_cache.get(list(self.current_images.values())[0].path, None))
+                path = list(self.current_images.values())[0].path
+                pixmap = self.image_cache.get(path)
+                if pixmap is None:
+                    # a disk cache hit is cheap enough to show without a round trip through the pool
+                    image = self.thumbnail_loader.load_cached(path, self.thumbnail_size)
+                    if image is not None:
+                        pixmap = self.image_cache[path] = QPixmap.fromImage(image)
+                if pixmap is not None:
+                    self.label.setPixmap(pixmap)
+                else:
+                    self.label.setText('Loading ...')
+                    self.thumbnail_loader.request(path, self.thumbnail_size)
                 self.label.show()
                 self.thumbnail_list.hide()
+                self.thumbnail_model.set_paths([])
             else:
                 self.label.setText(f'{len(self.current_images)} images selected')
                 self.label.hide()
                 self.thumbnail_list.show()
-                self.thumbnail_list.clear()
-                for path in self.current_images:
-                    self.thumbnail_list.addItem(QListWidgetItem(QIcon(self.image_cache.get(path, None)), os.path.basename(path)))
- 
+                # the view asks for the icons of the rows it paints, which requests their decodes
+                self.thumbnail_model.set_paths(self.current_images)
+                self.thumbnail_list.scrollToTop()
+
+    def partial_tag_count(self, tag):
+        return self.current_images.partial(tag) if len(self.current_images) > 1 else None
+
+    def request_grid_icon(self, path):
+        pixmap = self.image_cache.peek(path)
+        if pixmap is not None:
+            # scaling down a cached preview beats decoding the file again
+            self.icon_cache[path] = pixmap.scaledToWidth(self.grid_icon_size, Qt.SmoothTransformation)
+            QTimer.singleShot(0, lambda: self.thumbnail_model.thumbnail_ready(path))
+        else:
+            self.thumbnail_loader.request(path, self.grid_icon_size)
+
+    def prefetch_grid_icons(self, margin=2):
+        """Drop decodes for rows scrolled away, request the visible rows and a few screens around them"""
+        view = self.thumbnail_list
+        rect = view.viewport().rect()
+        first = view.indexAt(rect.topLeft() + QPoint(5, 5))
+        last = view.indexAt(rect.bottomRight() - QPoint(5, 5))
+        first_row = first.row() if first.isValid() else 0
+        last_row = last.row() if last.isValid() else min(self.thumbnail_model.rowCount(), first_row + 64) - 1
+        page = last_row - first_row + 1
+        self.thumbnail_loader.cancel()
+        paths = self.thumbnail_model.paths
+        for row in range(max(0, first_row - margin*page), min(len(paths), last_row + 1 + margin*page)):
+            if paths[row] not in self.icon_cache:
+                self.request_grid_icon(paths[row])
+
+    def on_thumbnail_loaded(self, path, width, image):
+        pixmap = QPixmap.fromImage(image)
+        if width == self.grid_icon_size:
+            self.icon_cache[path] = pixmap
+            self.thumbnail_model.thumbnail_ready(path)
+        elif width == self.thumbnail_size:
+            self.image_cache[path] = pixmap
+            if len(self.current_images) == 1 and path in self.current_images:
+                self.label.setPixmap(pixmap)
+
     def on_thumbnail_selection_changed(self):
-        selection = self.thumbnail_list.selectedItems()
-        files = []
+        selection = self.thumbnail_list.selectionModel().selectedRows()
         if len(selection) == 0:
-            for item in self.thumbnail_list.findItems('', Qt.MatchContains):
-                files.append(self.filepath_cache[item.text()])
+            files = list(self.thumbnail_model.paths)
         else:
-            for item in selection:
-                files.append(self.filepath_cache[item.text()])
+            files = [index.data(Qt.UserRole) for index in selection]
+        self.selection_from_tree = False
         self.set_active_images(files, False)
 
     def switch_files(self, indices):
@@ -489,43 +3510,127 @@ class ImageTagger(QMainWindow):
         files = []
         for index in indices:
             path = self.model.filePath(index)
-            if path not in self.image_cache:
-                self.image_cache[path] = QPixmap(path).scaledToWidth(self.thumbnail_size)
-            self.filepath_cache[os.path.basename(path)] = path
             if path in processed_files: # skip duplicates, as multiple indices can point to the same file
                 continue
             processed_files.add(path)
             if not self.is_image_file(index):
                 continue
             files.append(path)
+        self.selection_from_tree = True
         self.set_active_images(files, True)
+
+    def selected_images(self, selection):
+        """Paths of the image files in the ranges of an QItemSelection, one index per row"""
+        files = []
+        for item_range in selection:
+            parent = item_range.parent()
+            for row in range(item_range.top(), item_range.bottom() + 1):
+                index = self.model.index(row, 0, parent)
+                if self.is_image_file(index):
+                    files.append(self.model.filePath(index))
+        return files
       
     def closeEvent(self, event):
         self.save_current_tags()
-
-    def find_index_by_basename(self, basenames):
-        indices = []
-        for name in basenames:
-            if name in self.filepath_cache:
-                index = self.model.index(self.filepath_cache[name])
-                if index.isValid():
-                    indices.append(self.model.index(self.filepath_cache[name]))
-        return indices
-
-    def thumbnail_double_clicked(self, item):
-        indices = self.find_index_by_basename([item.text()])
-        if len(indices) < 1:
+        self.tag_writer.flush()
+        if self.tag_writer.failed:
+            failed = '\n'.join(f'{tag_path}: {error}' for tag_path, error in list(self.tag_writer.failed.items())[:20])
+            QMessageBox.warning(self, 'Failed to Save Tags', f'{len(self.tag_writer.failed)} tag files could not be saved:\n{failed}')
+        self.save_session()
+        self.tag_scanner.stop()
+        self.thumbnail_loader.cancel()
+        self.thumbnail_loader.pool.waitForDone()
+        if self.disk_cache:
+            self.disk_cache.gc()
+
+    def save_session(self):
+        """Remember the window, the dataset and its selection for restore_session, and snapshot the tag index"""
+        settings = session_settings()
+        settings.setValue('geometry', self.saveGeometry())
+        settings.setValue('splitter', self.splitter.saveState())
+        settings.setValue('right_panel', self.right_panel.saveState())
+        settings.setValue('flat_list', self.flat_list_action.isChecked())
+        settings.setValue('subfolders', self.subfolders_action.isChecked())
+        settings.setValue('directory', self.current_directory or '')
+        # keyboard navigation selects single cells, not whole rows
+        selection = dict.fromkeys(self.model.filePath(index) for index in self.tree.selectionModel().selectedIndexes())
+        settings.setValue('selection', list(selection)[:self.session_selection_limit])
+        current = self.tree.currentIndex()
+        settings.setValue('current', self.model.filePath(current) if current.isValid() else '')
+        # the previews shown last, decoded again in the background after a restore
+        settings.setValue('previews', list(self.image_cache.entries)[-self.session_previews:])
+        settings.sync()
+        self.save_tag_snapshot()
+
+    def save_tag_snapshot(self):
+        """Write what the tag scanner read of the current directory, so the next scan of it only reads changed sidecars"""
+        if not self.current_directory or self.tag_database or self.tag_scanner.directory != self.current_directory:
+            return
+        # the tags of a failed write aren't what the unchanged sidecar says
+        folders = self.tag_scanner.snapshot(self.tag_cache, set(self.tag_writer.failed))
+        try:
+            with perf.span('snapshot.write'):
+                write_tag_snapshot(tag_snapshot_path(self.current_directory), folders)
+        except OSError as e:
+            self.statusBar().showMessage(f'Failed to write the tag snapshot: {e}')
+
+    def restore_session(self):
+        """Bring back the window and the dataset of the last session. The selection follows once its rows are listed,
+        the tags come from the snapshot as far as the sidecars didn't change and the previews are decoded after that"""
+        settings = session_settings()
+        geometry = settings.value('geometry')
+        if geometry is not None:
+            self.restoreGeometry(geometry)
+        for splitter, key in ((self.splitter, 'splitter'), (self.right_panel, 'right_panel')):
+            state = settings.value(key)
+            if state is not None:
+                splitter.restoreState(state)
+        directory = settings.value('directory', '')
+        if not directory or not os.path.isdir(directory):
+            return
+        # nothing is listed before switch_directory, so this doesn't list anything twice
+        self.subfolders_action.setChecked(settings.value('subfolders', False, type=bool))
+        self.flat_list_action.setChecked(settings.value('flat_list', False, type=bool))
+        self.pending_selection = (settings.value('selection', [], type=list), settings.value('current', '', type=str),
+                                  settings.value('previews', [], type=list))
+        self.pending_listed = False
+        self.switch_directory(directory)
+
+    def restore_selection(self, listed=False):
+        """Select what was selected in the restored session once it is listed and the tag scan delivered its tags,
+        reading the sidecars of a large selection one by one on the GUI thread would freeze the window"""
+        if self.pending_selection is None:
             return
-        index_in_tree = indices[0]
+        self.pending_listed = self.pending_listed or listed
+        if not self.pending_listed or not (self.tag_database or self.tag_scanner.complete):
+            return
+        paths, current, previews = self.pending_selection
+        self.pending_selection = None
+        self.select_paths(paths)
+        index = self.model.index(current) if current else QModelIndex()
+        if index.isValid():
+            self.tree.selectionModel().setCurrentIndex(index, QItemSelectionModel.NoUpdate)
+            self.tree.scrollTo(index)
+        for path in previews:
+            if self.image_cache.peek(path) is None:
+                self.thumbnail_loader.request(path, self.thumbnail_size, priority=0)
+
+    def thumbnail_double_clicked(self, index):
+        index_in_tree = self.model.index(index.data(Qt.UserRole))
         if index_in_tree.isValid():
             self.tree.selectionModel().select(index_in_tree, QItemSelectionModel.ClearAndSelect)
             self.tree.scrollTo(index_in_tree)
 
     # Define a function to update the label widget with the selected image
-    def on_tree_selection_changed(self, itemSelection):
-        selected = self.tree.selectedIndexes()
-        self.switch_files(selected)
-        print(f'selection changed, {len(self.current_images)} images out of {len(selected)} items selected')
+    def on_tree_selection_changed(self, selected, deselected):
+        with perf.span('selection_changed'):
+            if self.selection_from_tree:
+                # only look at the rows that came and went, extending a large selection by one row stays cheap
+                removed = self.selected_images(deselected)
+                added = self.selected_images(selected)
+                self.update_active_images(added, removed)
+            else:
+                self.switch_files(self.tree.selectedIndexes())
 
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls():
@@ -550,21 +3655,69 @@ class ImageTagger(QMainWindow):
             event.ignore()
 
     def switch_directory(self, directory):
-        self.tagpool.clear()
+        # edits of the selection belong to the dataset being left, save them before its database and cache go,
+        # and forget the selection so list_directory has nothing left to save into the new one
+        self.save_current_tags()
+        self.current_images.clear()
+        self.common_tags = set()
         tagfile = os.path.join(os.path.dirname(directory), 'tags.txt')
         tagset = set()
         if os.path.isfile(tagfile):
             for tag in open(tagfile).read().split(','):
                 tag = tag.strip()
                 if tag and tag not in tagset:
-                    self.tagpool.addItem(tag)
                     tagset.add(tag)
-            self.tagpool.sortItems()
+
+        self.tagpool_model.set_tags(tagset)
+
+        self.tag_writer.flush()
+        self.save_tag_snapshot()
+        if self.tag_database and self.tag_database.root != directory.rstrip('/\\'):
+            self.tag_writer.set_database(None)
+            self.tag_database.close()
+            self.tag_database = None
+        self.current_directory = directory
+        self.tag_cache.clear()
+        self.tag_scanner.stop()
+        if self.tag_database or os.path.isfile(tag_database_path(directory)):
+            # the tag database is the source of truth while it exists, one query instead of a read per sidecar
+            self.tag_database = self.tag_database or TagDatabase(directory)
+            self.tag_writer.set_database(self.tag_database)
+            self.on_tags_loaded(self.tag_scanner.generation, time.monotonic(), self.tag_database.load())
+        else:
+            # index the sidecars of the whole directory in the background, not only the images clicked so far
+            self.scan_progress.setRange(0, 0)
+            self.scan_progress.show()
+            self.tag_scanner.start(directory, tag_snapshot_path(directory))
 
         self.taglist.clearSelection()
         self.tagpool.clearSelection()
-        self.model.setRootPath(directory)
-        self.tree.setRootIndex(self.model.index(directory))
+        self.list_directory()
+
+    def list_directory(self):
+        if not self.current_directory:
+            return
+        # the listing is replaced under the selection, a model reset drops it without a selectionChanged
+        self.set_active_images([])
+        self.selection_from_tree = False
+        if self.model is self.dataset_model:
+            self.dataset_model.start(self.current_directory, self.subfolders_action.isChecked())
+        else:
+            self.tree.clearSelection()
+            self.file_model.setRootPath(self.current_directory)
+            self.tree.setRootIndex(self.file_model.index(self.current_directory))
+
+    def set_flat_list(self, enabled):
+        """Show the images in a flat sortable list instead of the file system tree"""
+        self.save_current_tags()
+        self.dataset_model.stop()
+        self.tree.clearSelection()
+        self.tree.hide()
+        self.model = self.dataset_model if enabled else self.file_model
+        self.tree = self.dataset_view if enabled else self.file_tree
+        self.tree.show()
+        self.selection_from_tree = False
+        self.list_directory()
 
     # Define a function to choose directory
     def choose_directory(self):
@@ -575,8 +3728,41 @@ class ImageTagger(QMainWindow):
     def is_image_file(self, index):
         return self.model.fileName(index).lower().endswith(('.png', '.jpg', '.jpeg'))
 
+    def neighbour_images(self, index, step, count):
+        """Paths of up to count image files below (step 1) or above (step -1) index in the tree"""
+        paths = []
+        path = self.model.filePath(index)
+        while len(paths) < count:
+            index = self.tree.indexBelow(index) if step > 0 else self.tree.indexAbove(index)
+            if not index.isValid():
+                break
+            if self.is_image_file(index) and self.model.filePath(index) != path:
+                path = self.model.filePath(index)
+                paths.append(path)
+        return paths
+
+    def prefetch_neighbours(self, index, direction):
+        """Decode previews and read tags of the images around index, mostly ahead in the direction of navigation,
+        so the next Ctrl+N / Ctrl+P is served from the caches"""
+        if direction == self.nav_direction:
+            self.nav_streak += 1
+        else:
+            self.nav_direction = direction
+            self.nav_streak = 1
+        # look further ahead the longer the user keeps going the same way
+        ahead = self.prefetch_ahead * min(self.nav_streak, 4) // 2 or 1
+        paths = self.neighbour_images(index, direction, ahead) + self.neighbour_images(index, -direction, self.prefetch_behind)
+        missing_tags = []
+        for path in paths:
+            if self.image_cache.peek(path) is None:
+                self.thumbnail_loader.request(path, self.thumbnail_size, priority=0)
+            if path not in self.tag_cache:
+                tag_path = sidecar_path(path)
+                missing_tags.append((path, tag_path if os.path.exists(tag_path) else None))
+        if missing_tags:
+            self.tag_scanner.load(missing_tags)
+
     def keyPressEvent(self, event):
-        print(f'{event.key()} pressed')
         if event.modifiers() == Qt.ControlModifier:
             if event.key() == Qt.Key_N:
                 # Select next image file
@@ -585,13 +3771,13 @@ class ImageTagger(QMainWindow):
                 while True:
                     next_index = self.tree.indexBelow(next_index)
                     if not next_index.isValid():
-                        print('no next')
                         break
                     if self.model.fileName(next_index) != current_fn and self.is_image_file(next_index):
-                        print(f'next: {self.model.filePath(next_index)}')
-                        self.tree.setCurrentIndex(next_index)
-                        self.tree.selectionModel().select(next_index, QItemSelectionModel.ClearAndSelect)
-                        self.switch_files([next_index])
+                        # the selection change brings in the image, through on_tree_selection_changed
+                        with perf.span('navigate.next'):
+                            self.tree.setCurrentIndex(next_index)
+                            self.tree.selectionModel().select(next_index, QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
+                        self.prefetch_neighbours(next_index, 1)
                         break
                 return
             elif event.key() == Qt.Key_P:
@@ -601,27 +3787,257 @@ class ImageTagger(QMainWindow):
                 while True:
                     prev_index = self.tree.indexAbove(prev_index)
                     if not prev_index.isValid():
-                        print('no prev')
                         break
                     if self.model.fileName(prev_index) != current_fn and self.is_image_file(prev_index):
-                        print(f'prev: {self.model.filePath(prev_index)}')
-                        self.tree.setCurrentIndex(prev_index)
-                        self.tree.selectionModel().select(prev_index, QItemSelectionModel.ClearAndSelect)
-                        self.switch_files([prev_index])
+                        # the selection change brings in the image, through on_tree_selection_changed
+                        with perf.span('navigate.prev'):
+                            self.tree.setCurrentIndex(prev_index)
+                            self.tree.selectionModel().select(prev_index, QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
+                        self.prefetch_neighbours(prev_index, -1)
                         break
                 return
         super().keyPressEvent(event)
 
 
-if __name__ == '__main__':
-    # Create the main window
-    app = QApplication([])
-    window = ImageTagger()
-
-    # Show the main window
-    window.show()
-
-    # Run the event loop
-    app.exec_()
+def iter_input_paths(inputs, recursive=True):
+    """Yield (image_path, root) for image files and directory trees given on the command line,
+    `-` reads one path per line from stdin, nothing is listed in memory up front"""
+    for item in inputs or ['-']:
+        if item == '-':
+            for line in sys.stdin:
+                line = line.strip()
+                if line.lower().endswith(image_extensions):
+                    yield line, None
+        elif os.path.isdir(item):
+            for path, _ in scan_images(item, recursive):
+                yield path, item
+        else:
+            yield item, None
+
+def edit_sidecar(path, added_tags=(), removed_tags=()):
+    """Apply tag changes to the sidecar of an image, returns (path, tags, changed, error or None)"""
+    tag_path = sidecar_path(path)
+    try:
+        try:
+            tags = read_sidecar(tag_path)
+        except FileNotFoundError:
+            tags = []
+        new_tags = apply_tag_changes(tags, added_tags, removed_tags)
+        if new_tags != tags:
+            write_sidecar(tag_path, new_tags)
+            return path, new_tags, True, None
+    except OSError as e:
+        return path, [], False, f'{tag_path}: {e}'
+    return path, tags, False, None
+
+def print_event(**event):
+    print(json.dumps(event), flush=event.get('event') != 'file')
+
+def split_tags(values):
+    return [tag.strip() for value in values or [] for tag in value.split(',') if tag.strip()]
+
+def cli_crop(args):
+    created_dirs = set()
+    num_done = num_failed = 0
+    stamps = {}
+
+    def jobs():
+        nonlocal num_done, num_failed
+        for path, root in iter_input_paths(args.inputs, args.recursive):
+            save_dir = args.out
+            if root is not None:
+                # keep the layout of directory trees, flat file lists go straight into --out
+                save_dir = os.path.join(args.out, os.path.relpath(os.path.dirname(path), root))
+            outputs = []
+            for width, height in sizes:
+                size_dir = save_dir if len(sizes) == 1 else os.path.join(args.out, size_folder(width, height), os.path.relpath(save_dir, args.out))
+                outputs.append((os.path.join(size_dir, args.prefix + os.path.basename(path)), width, height))
+            if manifest is not None:
+                stamp = manifest.stamp(path, outputs, args.buckets, args.copy_tags)
+                if manifest.is_done(path, stamp):
+                    num_done += 1
+                    print_event(event='file', path=path, ok=True, message='unchanged')
+                    continue
+                stamps[path] = stamp
+            try:
+                for save_path, _, _ in outputs:
+                    size_dir = os.path.dirname(save_path)
+                    if size_dir not in created_dirs:
+                        os.makedirs(size_dir, exist_ok=True)
+                        created_dirs.add(size_dir)
+            except OSError as e:
+                num_done += 1
+                num_failed += 1
+                message = f'failed to create {size_dir}: {e}'
+                if path in stamps:
+                    manifest.record(path, stamps.pop(path), False, message)
+                print_event(event='file', path=path, ok=False, message=message)
+                continue
+            yield path, outputs, args.override or (manifest is not None and path in manifest.entries), args.buckets, args.copy_tags
+
+    sizes = list(dict.fromkeys(args.size or [(args.width, args.height)]))
+    manifest = None
+    if args.resume:
+        os.makedirs(args.out, exist_ok=True)
+        manifest = CropManifest(crop_manifest_path(args.out))
+    started = last_report = time.perf_counter()
+    try:
+        with make_executor(args.workers, args.processes) as executor:
+            for future in imap_unordered_bounded(executor, crop_resize_outputs, jobs(), args.workers * 2):
+                try:
+                    path, ok, message = future.result()
+                except Exception as e:
+                    path, ok, message = '', False, str(e)
+                num_done += 1
+                num_failed += not ok
+                if path in stamps and message != 'exists':
+                    manifest.record(path, stamps.pop(path), ok, message)
+                print_event(event='file', path=path, ok=ok, message=message)
+                if time.perf_counter() - last_report > args.progress_interval:
+                    last_report = time.perf_counter()
+                    print_event(event='progress', done=num_done, failed=num_failed, rate=num_done / (last_report - started))
+                    if manifest is not None:
+                        manifest.flush()
+    finally:
+        if manifest is not None:
+            manifest.close()
+    elapsed = time.perf_counter() - started
+    print_event(event='done', done=num_done, failed=num_failed, seconds=elapsed, rate=num_done / max(elapsed, 1e-6))
+    return 1 if num_failed else 0
+
+def cli_tags(args):
+    added_tags = split_tags(args.add)
+    removed_tags = split_tags(args.remove)
+    counts = {}
+    num_done = num_changed = num_failed = 0
+    started = last_report = time.perf_counter()
+    jobs = ((path, added_tags, removed_tags) for path, _ in iter_input_paths(args.inputs, args.recursive))
+    with ThreadPoolExecutor(args.workers) as executor:
+        for future in imap_unordered_bounded(executor, edit_sidecar, jobs, args.workers * 4):
+            path, tags, changed, error = future.result()
+            num_done += 1
+            if error is not None:
+                num_failed += 1
+                print_event(event='file', path=path, ok=False, error=error)
+                continue
+            num_changed += changed
+            if args.count:
+                for tag in tags:
+                    counts[tag] = counts.get(tag, 0) + 1
+            if args.list or changed:
+                print_event(event='file', path=path, tags=tags, changed=changed)
+            if time.perf_counter() - last_report > args.progress_interval:
+                last_report = time.perf_counter()
+                print_event(event='progress', done=num_done, changed=num_changed, rate=num_done / (last_report - started))
+    if args.count:
+        print_event(event='counts', counts=dict(sorted(counts.items(), key=lambda item: -item[1])))
+    print_event(event='done', done=num_done, changed=num_changed, failed=num_failed, seconds=time.perf_counter() - started)
+    return 1 if num_failed else 0
+
+def cli_db(args):
+    started = time.perf_counter()
+    database = TagDatabase(args.directory)
+    progress = lambda done, total: print_event(event='progress', done=done, total=total)
+    if args.action == 'import':
+        count = database.import_sidecars(args.workers, progress)
+    else:
+        count = database.export_sidecars(args.workers, progress)
+    database.close()
+    print_event(event='done', action=args.action, done=count, seconds=time.perf_counter() - started)
+    return 0
+
+def cli_export(args):
+    started = last_report = time.perf_counter()
+
+    def progress(done, total):
+        nonlocal last_report
+        if time.perf_counter() - last_report > args.progress_interval:
+            last_report = time.perf_counter()
+            print_event(event='progress', done=done, rate=done / (last_report - started))
+
+    samples = ((path, None) for path, _ in iter_input_paths(args.inputs, args.recursive))
+    entries, failed = export_shards(samples, args.out, args.shard_size, args.size, args.workers, args.prefix, progress)
+    for path, error in failed:
+        print_event(event='file', path=path, ok=False, message=error)
+    print_event(event='done', shards=len(entries), done=sum(len(entry['sources']) for entry in entries), failed=len(failed),
+                seconds=time.perf_counter() - started)
+    return 1 if failed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Little Tagger, runs the GUI without a command, '
+                                     'commands run headless and print one JSON object per line')
+    parser.add_argument('--trace', help='record timing spans and write them to this Chrome trace file on exit')
+    parser.add_argument('--fresh', action='store_true', help="don't restore the directory and selection of the last session")
+    subparsers = parser.add_subparsers(dest='command')
+
+    def add_common_arguments(command):
+        command.add_argument('inputs', nargs='*', help='image files or directories, `-` or nothing reads paths from stdin')
+        command.add_argument('--no-recursive', dest='recursive', action='store_false', help="don't descend into subdirectories")
+        command.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        command.add_argument('--progress-interval', type=float, default=1.0, help='seconds between progress lines')
+
+    crop = subparsers.add_parser('crop', help='resize and center crop images, like the Resize / Crop dialog')
+    add_common_arguments(crop)
+    crop.add_argument('--width', type=int, default=512)
+    crop.add_argument('--height', type=int, default=512)
+    crop.add_argument('--size', type=lambda text: parse_sizes(text)[0], action='append',
+                      help='WIDTHxHEIGHT, repeatable, every size is saved into its own subfolder of --out from one decode')
+    crop.add_argument('--buckets', action='store_true', help='save each image only in the --size closest to its aspect ratio')
+    crop.add_argument('--copy-tags', action='store_true', help='copy the tag sidecars next to the outputs')
+    crop.add_argument('--out', required=True, help='directory to save to')
+    crop.add_argument('--prefix', default='', help='file name prefix')
+    crop.add_argument('--override', action='store_true', help='override existing files')
+    crop.add_argument('--processes', action='store_true', help='use worker processes instead of threads')
+    crop.add_argument('--no-resume', dest='resume', action='store_false',
+                      help="redo images an earlier run into --out already saved, by default they're skipped unless they changed")
+
+    export = subparsers.add_parser('export', help='write images with their tags as captions into tar shards, with an index.jsonl of the member offsets')
+    add_common_arguments(export)
+    export.add_argument('--out', required=True, help='directory to write the shards to')
+    export.add_argument('--shard-size', type=int, default=1000, help='images per shard')
+    export.add_argument('--size', type=lambda text: parse_sizes(text)[0], help='WIDTHxHEIGHT to resize and center crop to, the images are copied as they are without')
+    export.add_argument('--prefix', default='data', help='shard file name prefix')
+
+    tags = subparsers.add_parser('tags', help='add, remove, list or count sidecar tags')
+    add_common_arguments(tags)
+    tags.add_argument('--add', action='append', help='tags to add, comma separated, repeatable')
+    tags.add_argument('--remove', action='append', help='tags to remove, comma separated, repeatable')
+    tags.add_argument('--list', action='store_true', help='print the tags of every image')
+    tags.add_argument('--count', action='store_true', help='print how many images carry each tag')
+
+    database = subparsers.add_parser('db', help='import sidecars into, or export them from, the tag database of a dataset')
+    database.add_argument('action', choices=['import', 'export'])
+    database.add_argument('directory')
+    database.add_argument('--workers', type=int, default=16)
+
+    args = parser.parse_args(argv)
+    if args.trace:
+        perf.enabled = True
+    try:
+        if args.command == 'crop':
+            return cli_crop(args)
+        if args.command == 'tags':
+            return cli_tags(args)
+        if args.command == 'export':
+            return cli_export(args)
+        if args.command == 'db':
+            return cli_db(args)
+
+        # Create the main window
+        app = QApplication([])
+        window = ImageTagger()
+
+        # Show the main window
+        window.show()
+        if not args.fresh:
+            window.restore_session()
+
+        # Run the event loop
+        return app.exec_()
+    finally:
+        if args.trace:
+            perf.export_trace(args.trace)
 
 
+if __name__ == '__main__':
+    sys.exit(main())